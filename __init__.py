@@ -33,9 +33,15 @@ def get_tag_name_by_id(id):
     return result
 
 
+# content columns in table order, callers unpack metadata rows by position
+sql_content_metadata_columns = (
+    "id, file_path, title, content_type, description, addition_date, origin, origin_content_id, hidden"
+)
+
+
 def get_content_metadata_by_file_path(path: pathlib.Path, connection):
     cursor = connection.cursor()
-    sql_template = "SELECT * FROM content WHERE file_path=%s"
+    sql_template = "SELECT {} FROM content WHERE file_path=%s".format(sql_content_metadata_columns)
     cursor.execute(sql_template, (str(path),))
     result = cursor.fetchone()
     return result
@@ -43,7 +49,7 @@ def get_content_metadata_by_file_path(path: pathlib.Path, connection):
 
 def get_content_metadata_by_content_id(content_id: int, connection):
     cursor = connection.cursor()
-    sql_template = "SELECT * FROM content WHERE id=%s"
+    sql_template = "SELECT {} FROM content WHERE id=%s".format(sql_content_metadata_columns)
     cursor.execute(sql_template, (content_id,))
     result = cursor.fetchone()
     return result
@@ -150,23 +156,31 @@ sql_insert_content_id_to_tag_id = \
 
 
 def add_tags_for_content(content_id, tags: list[tuple[str, str, str]], connection):
+    # tags with category are looked up by name, tags without category by alias, one query for each kind
+    known_tag_ids = tags_indexer.check_tags_exist(
+        [(tag[0], tag[1]) for tag in tags if tag[1] is not None], connection
+    )
+    alias_tag_ids = tags_indexer.get_tag_ids_by_aliases(
+        [tag[2] for tag in tags if tag[1] is None], connection
+    )
+    # (tag name, category) to tag, repeated new tags are inserted once
+    new_tags: dict[tuple[str, str], tuple[str, str, str]] = dict()
+    for tag in tags:
+        if tag[1] is None:
+            if tag[2] not in alias_tag_ids:
+                raise Exception("Not registered tag error", tag[0])
+        elif (tag[0], tag[1]) not in known_tag_ids:
+            new_tags.setdefault((tag[0], tag[1]), tag)
+    if len(new_tags):
+        new_tag_ids = tags_indexer.insert_new_tags(list(new_tags.values()), connection)
+        known_tag_ids.update(zip(new_tags.keys(), new_tag_ids))
+
     cursor = connection.cursor()
     for tag in tags:
-        tag_id = None
         if tag[1] is not None:
-            tag_id = tags_indexer.check_tag_exists(tag[0], tag[1], connection)
+            tag_id = known_tag_ids[(tag[0], tag[1])]
         else:
-            get_id_by_tag_alias_sql = "SELECT tag_id FROM tag_alias WHERE title = %s"
-            cursor.execute(get_id_by_tag_alias_sql, (tag[2],))
-            tag_id = cursor.fetchone()
-
-        if tag_id is None and tag[1] is not None:
-            tag_id = tags_indexer.insert_new_tag(tag[0], tag[1], tag[2], connection)
-        elif tag_id is not None:
-            tag_id = tag_id[0]
-        else:
-            raise Exception("Not registered tag error", tag[0])
-
+            tag_id = alias_tag_ids[tag[2]]
         cursor.execute(sql_insert_content_id_to_tag_id, (content_id, tag_id))
 
     connection.commit()
@@ -213,12 +227,10 @@ def find_content_from_source(origin, origin_content_id, connection) -> tuple[int
     Search content by origin content ID
     :rtype: content_id: int, file_path: str
     """
-    sql_template = "SELECT ID, file_path FROM content WHERE origin = %s and origin_content_id = %s"
-    cursor = connection.cursor()
-    cursor.execute(sql_template, (origin, origin_content_id))
-    result = cursor.fetchone()
-    cursor.fetchall()
-    return result
+    sql_template = "SELECT ID, file_path FROM content WHERE origin = %s and origin_content_id = %s LIMIT 1"
+    with connection.cursor() as cursor:
+        cursor.execute(sql_template, (origin, origin_content_id))
+        return cursor.fetchone()
 
 
 def update_file_path(content_id, file_path: pathlib.Path, image_hash, connection):
@@ -237,19 +249,14 @@ def get_representation_by_content_id(content_id, connection) -> list[srs_indexer
         "SELECT format, compatibility_level, file_path FROM representations WHERE content_id=%s"
         " ORDER BY compatibility_level"
     )
-    cursor = connection.cursor()
-    cursor.execute(sql_get_representations, (content_id,))
-    results = []
-    raw_representation = cursor.fetchone()
-    while raw_representation is not None:
-        results.append(srs_indexer.ContentRepresentationUnit(
-            config.relative_to.joinpath(raw_representation[2]),
-            raw_representation[1],
-            raw_representation[0]
-        ))
-        raw_representation = cursor.fetchone()
-    cursor.close()
-    return results
+    with connection.cursor() as cursor:
+        cursor.execute(sql_get_representations, (content_id,))
+        return [
+            srs_indexer.ContentRepresentationUnit(
+                config.relative_to.joinpath(file_path), compatibility_level, _format
+            )
+            for _format, compatibility_level, file_path in cursor.fetchall()
+        ]
 
 
 def set_image_hash(content_id: int, image_hash: tuple[float, bytes, int, int], connection):
@@ -1,19 +1,20 @@
 import dataclasses
 import pathlib
 import datetime
-import json
+import shutil
 
 from typing import Any, Iterable
 
+import orjson
 import psycopg2.errors
 
 import common
 import config
 
-import xml.dom.minidom
+import xml.etree.ElementTree
 
 from common.backup import TagUnique, ImageHash, ContentRepresentationElement, AlbumOrder, AlternateSource, \
-    ContentDocument, TagDocument, file_template_regex
+    ContentDocument, TagDocument, get_mpd_file_templates, find_mpd_segment_files
 
 tag_uniq_ids: dict[TagUnique, int] = dict()
 base_path: pathlib.Path = pathlib.Path("medialib-dump")
@@ -26,76 +27,45 @@ def write_srs(save_path: pathlib.Path, file_name: str, srs_file_path: pathlib.Pa
     srs_abs_path = current_dir.joinpath(srs_file_path)
     parent_dir_path = srs_abs_path.parent
 
-    raw_data = json.load(srs_abs_path.open("r"))
-    video = None
-    if 'video' in raw_data['streams']:
-        video = raw_data['streams']['video']
-    audio_streams = None
-    if 'audio' in raw_data['streams']:
-        audio_streams = raw_data['streams']['audio']
-    subtitle_streams = None
-    if 'subtitles' in raw_data['streams']:
-        subtitle_streams = raw_data['streams']['subtitles']
-    image = None
-    if 'image' in raw_data['streams']:
-        image = raw_data['streams']['image']
-    streams_metadata = (video, image)
-
-    with open(srs_abs_path, "br") as fsrc:
-        with open(save_path.joinpath(file_name), "bw") as fd:
-            fd.write(fsrc.read())
-
-    files = []
-    if audio_streams is not None:
-        for audio_stream in audio_streams:
-            for channel in audio_stream["channels"]:
-                for level in audio_stream["channels"][channel]:
-                    files.append(audio_stream["channels"][channel][level])
-
-    for content_type_streams in streams_metadata:
-        if content_type_streams is not None:
-            for level in content_type_streams["levels"]:
-                files.append(content_type_streams["levels"][level])
+    streams = orjson.loads(srs_abs_path.read_bytes())['streams']
+    audio_streams = streams.get('audio')
+    streams_metadata = (streams.get('video'), streams.get('image'))
+
+    shutil.copyfile(srs_abs_path, save_path.joinpath(file_name))
+
+    files = [
+        file
+        for audio_stream in audio_streams or ()
+        for channel_levels in audio_stream["channels"].values()
+        for file in channel_levels.values()
+    ]
+    files.extend(
+        file
+        for content_type_streams in streams_metadata if content_type_streams is not None
+        for file in content_type_streams["levels"].values()
+    )
 
     for file in files:
         abs_file_path = parent_dir_path.joinpath(file)
         new_file_path = save_path.joinpath(file)
-        with open(abs_file_path, "br") as fsrc:
-            with open(new_file_path, "bw") as fd:
-                fd.write(fsrc.read())
+        shutil.copyfile(abs_file_path, new_file_path)
 
 
 def write_mpd(save_path: pathlib.Path, file_name: str, mpd_file_path: pathlib.Path):
 
-    list_files = []
-
     mpd_file = mpd_abs_path = current_dir.joinpath(mpd_file_path)
 
-    file_templates = set()
     parent_dir = mpd_file.parent
-    mpd_document: xml.dom.minidom.Document = xml.dom.minidom.parse(str(mpd_file))
-    segment_templates: Iterable[xml.dom.minidom.Element] = mpd_document.getElementsByTagName("SegmentTemplate")
-    for template in segment_templates:
-        file_templates.add(file_template_regex.sub("*", template.getAttribute("initialization")))
-        file_templates.add(file_template_regex.sub("*", template.getAttribute("media")))
-    #logger.debug(file_templates.__repr__())
-
-    file_templates_iterable: tuple[str] = tuple(file_templates)
-    for file_template in file_templates_iterable:
-        for file in parent_dir.glob(file_template):
-            if file.is_file():
-                list_files.append(file)
+    file_templates = get_mpd_file_templates(mpd_file)
+
+    list_files = find_mpd_segment_files(parent_dir, file_templates)
 
     mpd_new_file_path = save_path.joinpath(file_name)
-    with open(mpd_file, "br") as fsrc:
-        with open(mpd_new_file_path, "bw") as fd:
-            fd.write(fsrc.read())
+    shutil.copyfile(mpd_file, mpd_new_file_path)
 
     for file in list_files:
         new_file_path = save_path.joinpath(file.name)
-        with open(file, "br") as fsrc:
-            with open(new_file_path, "bw") as fd:
-                fd.write(fsrc.read())
+        shutil.copyfile(file, new_file_path)
 
 
 def write_regular(output_file_path: pathlib.Path, src_file_path: pathlib.Path):
@@ -103,9 +73,7 @@ def write_regular(output_file_path: pathlib.Path, src_file_path: pathlib.Path):
 
     abs_path = current_dir.joinpath(src_file_path)
 
-    with open(abs_path, "br") as fsrc:
-        with open(output_file_path, "bw") as fd:
-            fd.write(fsrc.read())
+    shutil.copyfile(abs_path, output_file_path)
 
 def load_file(file, hash_list):
     pass
@@ -127,8 +95,7 @@ def register_tag(tag_label: TagUnique, cursor) -> int:
         cursor.execute(sql_get_tag_id, (tag_label.title, tag_label.category))
         return cursor.fetchone()[0]
     serialised_tag_id = tag_uniq_ids[tag_label]
-    with open(base_path.joinpath("tags", f"{serialised_tag_id}.json"), "r") as f:
-        raw_tag_data = json.load(f)
+    raw_tag_data = orjson.loads(base_path.joinpath("tags", f"{serialised_tag_id}.json").read_bytes())
     parent_tag = None
     if raw_tag_data["parent"] is not None:
         parent_tag = TagUnique(raw_tag_data["parent"]["title"], raw_tag_data["parent"]["category"])
@@ -197,8 +164,7 @@ def register_album(artist_tag: TagUnique, set_tag: TagUnique, cursor):
         return album_id[0]
 
 def register_content(serialised_content_file: pathlib.Path, connection):
-    with open(serialised_content_file, "r") as f:
-        raw_content_data = json.load(f)
+    raw_content_data = orjson.loads(serialised_content_file.read_bytes())
     tags: set[TagUnique] = set()
     for raw_tag in raw_content_data["tags"]:
         tag = TagUnique(raw_tag["title"], raw_tag["category"])
@@ -334,7 +300,7 @@ def register_content(serialised_content_file: pathlib.Path, connection):
             write_regular(file_path, src_file_path)
     except FileNotFoundError as e:
         print("File not found \"{}\", content id = {}!".format(e.filename, content_id))
-    except xml.parsers.expat.ExpatError as e:
+    except xml.etree.ElementTree.ParseError as e:
         print("Invalid MPD file, content id = {}!".format(content_id))
 
     return content_id
@@ -342,8 +308,7 @@ def register_content(serialised_content_file: pathlib.Path, connection):
 
 
 def main():
-    with open(base_path.joinpath("tag_uniq_id.json"), "r") as f:
-        tag_uniq_ids_raw = json.load(f)
+    tag_uniq_ids_raw = orjson.loads(base_path.joinpath("tag_uniq_id.json").read_bytes())
 
     for item in tag_uniq_ids_raw:
         tag_id: int = item[2]
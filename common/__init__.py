@@ -1,5 +1,9 @@
+import contextlib
+import threading
+
 try:
     import psycopg2
+    import psycopg2.pool
 except ImportError:
     raise Exception("Connector psycopq2 not properly installed")
 
@@ -28,6 +32,76 @@ def make_connection():
     )
 
 
+connection_pool: psycopg2.pool.ThreadedConnectionPool | None = None
+_connection_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises PoolError when it is exhausted,
+# borrowers wait for free connection on this semaphore instead
+_connection_pool_slots: threading.BoundedSemaphore | None = None
+# connection shared by module level functions of indexing scripts
+connection = None
+
+
+def get_connection_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    global connection_pool, _connection_pool_slots
+    with _connection_pool_lock:
+        if connection_pool is None:
+            max_connections = getattr(config, "db_pool_max_connections", 16)
+            connection_pool = psycopg2.pool.ThreadedConnectionPool(
+                getattr(config, "db_pool_min_connections", 1),
+                max_connections,
+                host=config.db_host, database=config.db_name, user=config.db_user, password=config.db_password
+            )
+            _connection_pool_slots = threading.BoundedSemaphore(max_connections)
+    return connection_pool
+
+
+def _get_pooled_connection():
+    """
+    Borrows connection from pool, blocks until one is returned if all of them are in use.
+    """
+    pool = get_connection_pool()
+    _connection_pool_slots.acquire()
+    try:
+        return pool.getconn()
+    except BaseException:
+        _connection_pool_slots.release()
+        raise
+
+
+def _put_pooled_connection(_connection):
+    try:
+        get_connection_pool().putconn(_connection)
+    finally:
+        _connection_pool_slots.release()
+
+
+@contextlib.contextmanager
+def pooled_connection():
+    """
+    Borrows connection from pool, instead of opening new one, and returns it back on exit.
+    Waits for free connection when all db_pool_max_connections are in use.
+    Not committed transaction is rolled back by pool.
+    """
+    _connection = _get_pooled_connection()
+    try:
+        yield _connection
+    finally:
+        _put_pooled_connection(_connection)
+
+
+def open_connection_if_not_opened():
+    global connection
+    if connection is None:
+        connection = _get_pooled_connection()
+
+
+def close_connection_if_not_closed():
+    global connection
+    if connection is not None:
+        _put_pooled_connection(connection)
+        connection = None
+
+
 def postgres_string_format(tag_name, size):
     if tag_name is None:
         return None
@@ -1,17 +1,23 @@
 import dataclasses
 import datetime
+import fnmatch
+import os
 import pathlib
 import re
-from typing import Any
+import xml.etree.ElementTree
+from typing import Any, Iterable
 
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, slots=True)
 class TagUnique:
     title: str
     category: str
 
+    def json_serializable(self) -> dict[str, Any]:
+        return {"title": self.title, "category": self.category}
+
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, slots=True)
 class ImageHash:
     aspect_ratio: float
     value_hash: str
@@ -19,33 +25,54 @@ class ImageHash:
     saturation_hash: int
     alternate_version: bool
 
+    def json_serializable(self) -> dict[str, Any]:
+        return {
+            "aspect_ratio": self.aspect_ratio,
+            "value_hash": self.value_hash,
+            "hue_hash": self.hue_hash,
+            "saturation_hash": self.saturation_hash,
+            "alternate_version": self.alternate_version
+        }
+
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, slots=True)
 class ContentRepresentationElement:
     format: str
     compatibility_level: int
     file_path: pathlib.Path
 
     def json_serializable(self) -> dict[str, Any]:
-        serializable = dataclasses.asdict(self)
-        serializable["file_path"] = str(self.file_path)
-        return serializable
+        return {
+            "format": self.format,
+            "compatibility_level": self.compatibility_level,
+            "file_path": str(self.file_path)
+        }
 
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, slots=True)
 class AlbumOrder:
     set_tag: TagUnique
     artist_tag: TagUnique
     order: int
 
+    def json_serializable(self) -> dict[str, Any]:
+        return {
+            "set_tag": self.set_tag.json_serializable(),
+            "artist_tag": self.artist_tag.json_serializable(),
+            "order": self.order
+        }
+
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class AlternateSource:
     origin_name: str
     origin_content_id: str
 
+    def json_serializable(self) -> dict[str, Any]:
+        return {"origin_name": self.origin_name, "origin_content_id": self.origin_content_id}
+
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class ContentDocument:
     content_id: int
     file_path: pathlib.Path
@@ -63,18 +90,35 @@ class ContentDocument:
     albums: list[AlbumOrder] | None = None
 
     def json_serializable(self) -> dict[str, Any]:
-        serializable = dataclasses.asdict(self)
-        serializable["file_path"] = str(self.file_path)
-        serializable["addition_date"] = self.addition_date.isoformat()
-        serializable["tags"] = [dataclasses.asdict(tag) for tag in self.tags]
+        imagehash = None
+        if self.imagehash is not None:
+            imagehash = self.imagehash.json_serializable()
+        representations = None
         if self.representations is not None:
-            serializable["representations"] = [
-                repr.json_serializable() for repr in self.representations
-            ]
-        return serializable
-
-
-@dataclasses.dataclass
+            representations = [_repr.json_serializable() for _repr in self.representations]
+        albums = None
+        if self.albums is not None:
+            albums = [album.json_serializable() for album in self.albums]
+        return {
+            "content_id": self.content_id,
+            "file_path": str(self.file_path),
+            "title": self.title,
+            "content_type": self.content_type,
+            "description": self.description,
+            # encoded by orjson natively, same format as datetime.isoformat()
+            "addition_date": self.addition_date,
+            "origin": self.origin,
+            "origin_content_id": self.origin_content_id,
+            "is_hidden": self.is_hidden,
+            "tags": [tag.json_serializable() for tag in self.tags],
+            "alternate_sources": [alt_src.json_serializable() for alt_src in self.alternate_sources],
+            "imagehash": imagehash,
+            "representations": representations,
+            "albums": albums
+        }
+
+
+@dataclasses.dataclass(slots=True)
 class TagDocument:
     title: str
     category: str
@@ -82,11 +126,58 @@ class TagDocument:
     parent: TagUnique | None
 
     def json_serializable(self) -> dict[str, Any]:
-        serializable = dataclasses.asdict(self)
-        serializable["aliases"] = list(self.aliases)
+        parent = None
         if self.parent is not None:
-            serializable["parent"] = dataclasses.asdict(self.parent)
-        return serializable
+            parent = self.parent.json_serializable()
+        return {
+            "title": self.title,
+            "category": self.category,
+            "aliases": list(self.aliases),
+            "parent": parent
+        }
 
 
 file_template_regex = re.compile("\$[\da-zA-Z\-%]+\$")
+
+
+def get_mpd_file_templates(mpd_file: pathlib.Path) -> set[str]:
+    """
+    Collects glob patterns of segment files from SegmentTemplate elements of MPD file.
+    Document is parsed incrementally, without building DOM tree.
+    :raises xml.etree.ElementTree.ParseError: on malformed MPD file
+    """
+    file_templates = set()
+    for _, element in xml.etree.ElementTree.iterparse(mpd_file, events=("end",)):
+        if element.tag.rpartition("}")[2] == "SegmentTemplate":
+            file_templates.add(file_template_regex.sub("*", element.get("initialization", "")))
+            file_templates.add(file_template_regex.sub("*", element.get("media", "")))
+        element.clear()
+    return file_templates
+
+
+def find_mpd_segment_files(parent_dir: pathlib.Path, file_templates: Iterable[str]) -> list[pathlib.Path]:
+    """
+    Lists files of MPD directory matching any of segment file templates, with the same results as Path.glob.
+    Directory is scanned once, templates are combined into single regular expression,
+    templates pointing into subdirectories are globbed separately.
+    """
+    flat_templates = []
+    nested_templates = []
+    for file_template in file_templates:
+        if "/" in file_template or os.sep in file_template:
+            nested_templates.append(file_template)
+        else:
+            flat_templates.append(file_template)
+    # dictionary keeps files matched by several templates once, in order of finding
+    files: dict[pathlib.Path, None] = dict()
+    if len(flat_templates):
+        templates_regex = re.compile("|".join(fnmatch.translate(file_template) for file_template in flat_templates))
+        with os.scandir(parent_dir) as entries:
+            for entry in entries:
+                if templates_regex.match(entry.name) and entry.is_file():
+                    files[pathlib.Path(entry.path)] = None
+    for file_template in nested_templates:
+        for file in parent_dir.glob(file_template):
+            if file.is_file():
+                files[file] = None
+    return list(files)
@@ -9,3 +9,8 @@ db_password = ""
 relative_to = pathlib.Path("/")
 thumbnails_storage = pathlib.Path("/")
 enable_openclip = False
+# search inclusive tag groups with id = ANY(array_agg(...)) instead of IN (subquery)
+tag_search_array_semijoin = False
+# connections kept by common.get_connection_pool()
+db_pool_min_connections = 1
+db_pool_max_connections = 16
@@ -1,7 +1,9 @@
+import contextlib
+import logging
 import pathlib
 import enum
-import random
 import typing
+import weakref
 
 try:
     from . import config
@@ -13,6 +15,8 @@ try:
 except ImportError:
     import common
 
+logger = logging.getLogger(__name__)
+
 
 class ORDERING_BY(enum.Enum):
     DATE_DECREASING = enum.auto()
@@ -22,9 +26,10 @@ class ORDERING_BY(enum.Enum):
 
 
 ordering_constants = {
-    ORDERING_BY.DATE_DECREASING: "addition_date DESC",
-    ORDERING_BY.DATE_INCREASING: "addition_date",
-    ORDERING_BY.RANDOM: "RANDOM()"
+    ORDERING_BY.DATE_DECREASING: " ORDER BY addition_date DESC",
+    ORDERING_BY.DATE_INCREASING: " ORDER BY addition_date",
+    ORDERING_BY.RANDOM: " ORDER BY RANDOM()",
+    ORDERING_BY.NONE: ""
 }
 
 
@@ -34,12 +39,42 @@ class HIDDEN_FILTERING(enum.Enum):
     ONLY_HIDDEN = enum.auto()
 
 
+# keyed by (tag predicates emitted, filtering mode)
 hidden_filtering_constants = {
-    HIDDEN_FILTERING.SHOW: "",
-    HIDDEN_FILTERING.FILTER: " AND hidden=FALSE",
-    HIDDEN_FILTERING.ONLY_HIDDEN: " AND hidden=TRUE"
+    (True, HIDDEN_FILTERING.SHOW): "",
+    (True, HIDDEN_FILTERING.FILTER): " AND hidden=FALSE",
+    (True, HIDDEN_FILTERING.ONLY_HIDDEN): " AND hidden=TRUE",
+    (False, HIDDEN_FILTERING.SHOW): "",
+    (False, HIDDEN_FILTERING.FILTER): " WHERE hidden=FALSE",
+    (False, HIDDEN_FILTERING.ONLY_HIDDEN): " WHERE hidden=TRUE"
 }
 
+sql_search_template = "{base_sql_block}{tag_clause}{hidden_clause}{order_clause}{limit_clause}"
+
+
+sql_prepare_tag_ids_statements = (
+    "PREPARE mdb_get_tags_ids(varchar) AS SELECT DISTINCT id FROM get_tags_ids($1);"
+    "PREPARE mdb_get_parent_tag_ids(bigint) AS SELECT DISTINCT id FROM get_parent_tag_ids($1);"
+)
+
+# pooled connections live across many searches, statements are prepared once for each
+_search_prepared_connections = weakref.WeakSet()
+
+
+@contextlib.contextmanager
+def _search_connection():
+    """
+    Borrow pooled connection with tag resolving statements prepared,
+    as _requests_fabric executes them once per searched tag.
+    Concurrent searches over db_pool_max_connections wait for connection returned by others.
+    """
+    with common.pooled_connection() as connection:
+        if connection not in _search_prepared_connections:
+            with connection.cursor() as cursor:
+                cursor.execute(sql_prepare_tag_ids_statements)
+            _search_prepared_connections.add(connection)
+        yield connection
+
 
 def _requests_fabric(
         *tags_groups: dict[str, typing.Any],
@@ -50,56 +85,59 @@ def _requests_fabric(
         base_sql_block,
         cursor
         ):
-    get_image_id_by_tag_code_block = "id in (SELECT content_id from content_tags_list where tag_id in ({}))"
-    get_image_id_by_not_tag_code_block = "id not in (SELECT content_id from content_tags_list where tag_id in ({}))"
-    result_sql_block = base_sql_block
-
-    tag_ids = list()
-    tags_count = list()
-
-    sql_get_tag_ids = "SELECT * FROM get_tags_ids(%s)"
-    sql_get_parent_ids = "SELECT * FROM get_parent_tag_ids(%s)"
+    if getattr(config, "tag_search_array_semijoin", False):
+        # materialize every inclusive group once, so the planner can intersect them on content.id
+        get_image_id_by_tag_code_block = \
+            "id = ANY((SELECT array_agg(content_id) from content_tags_list where tag_id = ANY(%s)))"
+    else:
+        get_image_id_by_tag_code_block = "id in (SELECT content_id from content_tags_list where tag_id = ANY(%s))"
+    get_image_id_by_not_tag_code_block = "id not in (SELECT content_id from content_tags_list where tag_id = ANY(%s))"
+
+    resolved_groups: list[tuple[bool, list[int]]] = list()
+
+    sql_get_tag_ids = "EXECUTE mdb_get_tags_ids(%s)"
+    sql_get_parent_ids = "EXECUTE mdb_get_parent_tag_ids(%s)"
     for tags_group in tags_groups:
-        raw_tag_ids = []
+        _tag_ids = []
         for tag in tags_group["tags"]:
             if type(tag) is str:
                 cursor.execute(sql_get_tag_ids, (tag,))
             elif type(tag) is int:
                 cursor.execute(sql_get_parent_ids, (tag,))
-            data = cursor.fetchall()
-            raw_tag_ids.extend(data)
-        tags_count.append(len(raw_tag_ids))
-        _tag_ids = set()
-        for raw_id in raw_tag_ids:
-            _tag_ids.add(raw_id[0])
-        tag_ids.extend(_tag_ids)
-
-    tags_set_lists = list()
-    for i, val in enumerate(tags_count):
-        if tags_groups[i]["not"]: # not tag
-            result_sql_block += get_image_id_by_not_tag_code_block
+            _tag_ids.extend(row[0] for row in cursor.fetchall())
+        # hierarchies of group tags may overlap, every tag ID is kept once
+        resolved_groups.append((bool(tags_group["not"]), list(dict.fromkeys(_tag_ids))))
+
+    query_parameters: list[typing.Any] = list()
+    tag_blocks = list()
+    for is_not, group_tag_ids in resolved_groups:
+        if is_not:
+            tag_blocks.append(get_image_id_by_not_tag_code_block)
         else:
-            result_sql_block += get_image_id_by_tag_code_block
-        tag_set_list = "%s"
-        for j in range(1, val):
-            tag_set_list += ", %s"
-        tags_set_lists.append(tag_set_list)
-        if i + 1 < len(tags_count):
-            result_sql_block += " AND "
+            tag_blocks.append(get_image_id_by_tag_code_block)
+        query_parameters.append(group_tag_ids)
 
-    result_sql_block = result_sql_block.format(*tags_set_lists)
+    tag_clause = ""
+    if len(tag_blocks):
+        tag_clause = " WHERE " + " AND ".join(tag_blocks)
 
-    if filter_hidden != HIDDEN_FILTERING.SHOW:
-        result_sql_block += hidden_filtering_constants[filter_hidden]
-
-    if order_by != ORDERING_BY.NONE:
-        result_sql_block += " ORDER BY {}".format(ordering_constants[order_by])
+    limit_clause = ""
     if limit is not None:
-        result_sql_block += " LIMIT {}".format(limit)
+        limit_clause = " LIMIT %s"
+        query_parameters.append(limit)
         if offset is not None:
-            result_sql_block += " OFFSET {}".format(offset)
-    print(result_sql_block, tag_ids, type(tag_ids[0]))
-    cursor.execute(result_sql_block, tag_ids)
+            limit_clause = " LIMIT %s OFFSET %s"
+            query_parameters.append(offset)
+
+    result_sql_block = sql_search_template.format(
+        base_sql_block=base_sql_block,
+        tag_clause=tag_clause,
+        hidden_clause=hidden_filtering_constants[(len(tag_blocks) > 0, filter_hidden)],
+        order_clause=ordering_constants[order_by],
+        limit_clause=limit_clause
+    )
+    logger.debug("Resulting SQL: %s, parameters = %s", result_sql_block, query_parameters)
+    cursor.execute(result_sql_block, query_parameters)
 
 
 def get_media_by_tags(
@@ -109,39 +147,65 @@ def get_media_by_tags(
         order_by: ORDERING_BY = ORDERING_BY.NONE,
         filter_hidden: HIDDEN_FILTERING = HIDDEN_FILTERING.FILTER,
     ):
-    connection = common.make_connection()
-    cursor = connection.cursor()
-    base_sql_code_block = "SELECT ID, file_path, content_type, title from content where "
-    _requests_fabric(
-        *tags,
-        limit=limit,
-        offset=offset,
-        order_by=order_by,
-        base_sql_block=base_sql_code_block,
-        cursor=cursor,
-        filter_hidden=filter_hidden
-    )
-
-    list_files = list()
-    file_path = cursor.fetchone()
-    while file_path is not None:
-        list_files.append(file_path)
-        file_path = cursor.fetchone()
-    if order_by == ORDERING_BY.RANDOM:
-        random.shuffle(list_files)
-    connection.close()
+    base_sql_code_block = "SELECT ID, file_path, content_type, title from content"
+    with _search_connection() as connection, connection.cursor() as cursor:
+        _requests_fabric(
+            *tags,
+            limit=limit,
+            offset=offset,
+            order_by=order_by,
+            base_sql_block=base_sql_code_block,
+            cursor=cursor,
+            filter_hidden=filter_hidden
+        )
+
+        list_files = cursor.fetchall()
     return list_files
 
 
-def count_files_with_every_tag(*tags: dict[str, typing.Any], filter_hidden: HIDDEN_FILTERING = HIDDEN_FILTERING.FILTER):
-    base_sql_code_block = "SELECT COUNT(*) from content where "
-    connection = common.make_connection()
-    cursor = connection.cursor()
-    get_image_id_by_tag_code_block = ("id in (SELECT content_id from content_tags_list where tag_id = "
-                                      "(SELECT tag_id from tag_alias where title=%s))")
+def get_media_by_tags_with_total(
+        *tags: dict[str, typing.Any],
+        limit: int = None,
+        offset: int = None,
+        order_by: ORDERING_BY = ORDERING_BY.NONE,
+        filter_hidden: HIDDEN_FILTERING = HIDDEN_FILTERING.FILTER,
+    ) -> tuple[int, list[tuple]]:
+    """
+    Get page of media and total count of matched media in one query.
+    Use it for paginated listings instead of calling
+    get_media_by_tags and count_files_with_every_tag separately.
+    When offset is beyond the last matched media, total is counted by separate query.
+    :return: total count, list of (ID, file_path, content_type, title)
+    """
+    base_sql_code_block = "SELECT COUNT(*) OVER(), ID, file_path, content_type, title from content"
+    with _search_connection() as connection, connection.cursor() as cursor:
+        _requests_fabric(
+            *tags,
+            limit=limit,
+            offset=offset,
+            order_by=order_by,
+            base_sql_block=base_sql_code_block,
+            cursor=cursor,
+            filter_hidden=filter_hidden
+        )
+        raw_results = cursor.fetchall()
+        total = 0
+        if len(raw_results):
+            total = raw_results[0][0]
+        elif offset:
+            # page is empty, but there could be matches before it, so pagination could be clamped
+            _requests_fabric(
+                *tags, base_sql_block="SELECT COUNT(*) from content", cursor=cursor, filter_hidden=filter_hidden
+            )
+            (total,) = cursor.fetchone()
+    return total, [raw_result[1:] for raw_result in raw_results]
 
-    _requests_fabric(*tags, base_sql_block=base_sql_code_block, cursor=cursor, filter_hidden=filter_hidden)
 
-    result = cursor.fetchone()[0]
-    connection.close()
-    return result
+def count_files_with_every_tag(*tags: dict[str, typing.Any], filter_hidden: HIDDEN_FILTERING = HIDDEN_FILTERING.FILTER):
+    base_sql_code_block = "SELECT COUNT(*) from content"
+    with _search_connection() as connection, connection.cursor() as cursor:
+        _requests_fabric(*tags, base_sql_block=base_sql_code_block, cursor=cursor, filter_hidden=filter_hidden)
+
+        # COUNT(*) without GROUP BY always returns exactly one row
+        (count,) = cursor.fetchone()
+    return count
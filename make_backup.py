@@ -1,293 +1,399 @@
+import copy
 import dataclasses
+import functools
 import io
+import logging
+import os
 import pathlib
-import json
+import queue
+import stat
 import tarfile
-import xml.dom
-import xml.dom.minidom
-from typing import Iterable
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree
+from typing import BinaryIO
 
 import crcmod
+import orjson
 
 import common
 import common.backup
 import config
 from common.backup import TagUnique, ImageHash, ContentRepresentationElement, AlbumOrder, AlternateSource, \
-    ContentDocument, TagDocument, file_template_regex
+    ContentDocument, TagDocument, get_mpd_file_templates, find_mpd_segment_files
 
-tags_uniq: set[TagUnique] = set()
+logger = logging.getLogger(__name__)
 
 
-def write_srs(tar_dump, srs_file_path: pathlib.Path, content_id):
-    global checksums
-
+def write_srs(backup, srs_file_path: pathlib.Path, content_id):
     srs_abs_path = config.relative_to.joinpath(srs_file_path)
     parent_dir_path = srs_abs_path.parent
 
-    raw_data = json.load(srs_abs_path.open("r"))
-    video = None
-    if 'video' in raw_data['streams']:
-        video = raw_data['streams']['video']
-    audio_streams = None
-    if 'audio' in raw_data['streams']:
-        audio_streams = raw_data['streams']['audio']
-    subtitle_streams = None
-    if 'subtitles' in raw_data['streams']:
-        subtitle_streams = raw_data['streams']['subtitles']
-    image = None
-    if 'image' in raw_data['streams']:
-        image = raw_data['streams']['image']
-    streams_metadata = (video, image)
-
-    file_hash = 0
-    with srs_abs_path.open("br") as f:
-        file_hash = crc64(f.read())
-    srs_new_file_path = pathlib.PurePath("content/{}/{}.srs".format(content_id, content_id))
-    checksums.append((file_hash, srs_new_file_path))
-    tar_dump.add(name=str(srs_abs_path), arcname=str(srs_new_file_path))
-
-    files = []
-    if audio_streams is not None:
-        for audio_stream in audio_streams:
-            for channel in audio_stream["channels"]:
-                for level in audio_stream["channels"][channel]:
-                    files.append(audio_stream["channels"][channel][level])
-
-    for content_type_streams in streams_metadata:
-        if content_type_streams is not None:
-            for level in content_type_streams["levels"]:
-                files.append(content_type_streams["levels"][level])
+    streams = orjson.loads(srs_abs_path.read_bytes())['streams']
+    audio_streams = streams.get('audio')
+    streams_metadata = (streams.get('video'), streams.get('image'))
+
+    srs_new_file_path = "content/{}/{}.srs".format(content_id, content_id)
+    add_file(backup, srs_abs_path, srs_new_file_path)
+
+    files = [
+        file
+        for audio_stream in audio_streams or ()
+        for channel_levels in audio_stream["channels"].values()
+        for file in channel_levels.values()
+    ]
+    files.extend(
+        file
+        for content_type_streams in streams_metadata if content_type_streams is not None
+        for file in content_type_streams["levels"].values()
+    )
 
     for file in files:
-        file_hash = 0
         abs_file_path = parent_dir_path.joinpath(file)
-        with abs_file_path.open("br") as f:
-            file_hash = crc64(f.read())
-        new_file_path = pathlib.PurePath("content/{}/{}".format(content_id, file))
-        checksums.append((file_hash, new_file_path))
-        tar_dump.add(name=str(abs_file_path), arcname=str(new_file_path))
-
+        # manifest entries may carry "./" segments, keep them normalized
+        new_file_path = str(pathlib.PurePath("content/{}/{}".format(content_id, file)))
+        add_file(backup, abs_file_path, new_file_path)
 
-def write_mpd(tar_dump, mpd_file_path, content_id):
-    global checksums
-
-    list_files = []
 
+def write_mpd(backup, mpd_file_path, content_id):
     mpd_file = mpd_abs_path = config.relative_to.joinpath(mpd_file_path)
 
-    file_templates = set()
     parent_dir = mpd_file.parent
-    mpd_document: xml.dom.minidom.Document = xml.dom.minidom.parse(str(mpd_file))
-    segment_templates: Iterable[xml.dom.minidom.Element] = mpd_document.getElementsByTagName("SegmentTemplate")
-    for template in segment_templates:
-        file_templates.add(file_template_regex.sub("*", template.getAttribute("initialization")))
-        file_templates.add(file_template_regex.sub("*", template.getAttribute("media")))
-    #logger.debug(file_templates.__repr__())
-
-    file_templates_iterable: tuple[str] = tuple(file_templates)
-    for file_template in file_templates_iterable:
-        for file in parent_dir.glob(file_template):
-            if file.is_file():
-                list_files.append(file)
-
-    file_hash = 0
-    with mpd_abs_path.open("br") as f:
-        file_hash = crc64(f.read())
-    mpd_new_file_path = pathlib.PurePath("content/{}/{}.mpd".format(content_id, content_id))
-    checksums.append((file_hash, mpd_new_file_path))
-    tar_dump.add(name=str(mpd_abs_path), arcname=str(mpd_new_file_path))
+    file_templates = get_mpd_file_templates(mpd_file)
 
-    for file in list_files:
-        file_hash = 0
-        with file.open("br") as f:
-            file_hash = crc64(f.read())
-        new_file_path = pathlib.PurePath("content/{}/{}".format(content_id, file.name))
-        checksums.append((file_hash, new_file_path))
-        tar_dump.add(name=str(file), arcname=str(new_file_path))
+    list_files = find_mpd_segment_files(parent_dir, file_templates)
+
+    mpd_new_file_path = "content/{}/{}.mpd".format(content_id, content_id)
+    add_file(backup, mpd_abs_path, mpd_new_file_path)
 
+    for file in list_files:
+        new_file_path = "content/{}/{}".format(content_id, file.name)
+        add_file(backup, file, new_file_path)
 
-def write_regular(tar_dump, file_path: pathlib.Path, content_id):
-    global checksums
 
+def write_regular(backup, file_path: pathlib.Path, content_id):
     abs_path = config.relative_to.joinpath(file_path)
 
-    file_hash = 0
-    with abs_path.open("br") as f:
-        file_hash = crc64(f.read())
-    srs_new_file_path = pathlib.PurePath("content/{}{}".format(content_id, file_path.suffix))
-    checksums.append((file_hash, srs_new_file_path))
-    tar_dump.add(name=str(abs_path), arcname=str(srs_new_file_path))
+    srs_new_file_path = "content/{}{}".format(content_id, file_path.suffix)
+    add_file(backup, abs_path, srs_new_file_path)
+
 
+TAR_WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+# tarfile copies members with 16 KiB blocks by default
+TAR_COPY_BUFFER_SIZE = 1024 * 1024
 
 crc64 = crcmod.predefined.mkCrcFun("crc-64")
-checksums: list[tuple[int, pathlib.PurePath]] = []
+crc64_template = crcmod.predefined.PredefinedCrc("crc-64")
+
+# header fields shared by every generated document, only name and size differ,
+# mtime is set to dump time by main
+generated_file_tar_info = tarfile.TarInfo()
+
+
+@dataclasses.dataclass(slots=True)
+class BackupContext:
+    """
+    Archive being written and CRC-64 checksums of its members.
+    Checksum lines are spooled to temporary file as members are written,
+    instead of being kept in memory until the end of backup.
+    """
+    tar_dump: tarfile.TarFile
+    checksums_file: BinaryIO = dataclasses.field(default_factory=tempfile.TemporaryFile)
 
+    def add_checksum(self, checksum: int, path: str):
+        self.checksums_file.write(f"{checksum:x} {path}\n".encode("utf-8"))
 
-def create_tar_file(tar_dump: tarfile.TarFile, buffer: io.StringIO, path: pathlib.PurePath, write_crc=True):
-    encoded_data = buffer.getvalue().encode("utf-8")
-    if write_crc:
-        data_crc64 = crc64(encoded_data)
-        checksums.append((data_crc64, path))
+
+class CRCReader:
+    """
+    Read-only file wrapper, that updates CRC-64 with every read block,
+    so file is checksummed while tarfile copies it into archive.
+    """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.crc = crc64_template.new()
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.crc.update(data)
+        return data
+
+
+def add_file(backup: BackupContext, abs_path: pathlib.Path, arcname: str):
+    with abs_path.open("br") as f:
+        # built from fstat directly, gettarinfo() also looks up owner user and group names for every file
+        file_stat = os.fstat(f.fileno())
+        tar_info = copy.copy(generated_file_tar_info)
+        tar_info.name = arcname
+        tar_info.size = file_stat.st_size
+        tar_info.mtime = int(file_stat.st_mtime)
+        tar_info.mode = stat.S_IMODE(file_stat.st_mode)
+        tar_info.uid = file_stat.st_uid
+        tar_info.gid = file_stat.st_gid
+        crc_reader = CRCReader(f)
+        backup.tar_dump.addfile(tar_info, crc_reader)
+    backup.add_checksum(crc_reader.crc.crcValue, arcname)
+
+
+def create_tar_file(backup: BackupContext, encoded_data: bytes, path: str):
+    backup.add_checksum(crc64(encoded_data), path)
     data_buffer = io.BytesIO(encoded_data)
-    tar_tag_info = tarfile.TarInfo(str(path))
+    tar_tag_info = copy.copy(generated_file_tar_info)
+    tar_tag_info.name = path
     tar_tag_info.size = len(encoded_data)
-    tar_dump.addfile(tar_tag_info, data_buffer)
+    backup.tar_dump.addfile(tar_tag_info, data_buffer)
+
+
+def write_content(
+        backup: BackupContext,
+        content_document: ContentDocument,
+        content_document_data: bytes,
+        content_document_path: str
+):
+    content_id = content_document.content_id
+    try:
+        if content_document.file_path.suffix == ".srs":
+            write_srs(backup, content_document.file_path, content_id)
+        elif content_document.file_path.suffix == ".mpd":
+            write_mpd(backup, content_document.file_path, content_id)
+        else:
+            write_regular(backup, content_document.file_path, content_id)
+    except FileNotFoundError as e:
+        print("Missing file \"{}\", content id = {}!".format(e.filename, content_id))
+    except xml.etree.ElementTree.ParseError as e:
+        print("Invalid MPD file, content id = {}!".format(content_id))
+    else:
+        create_tar_file(backup, content_document_data, content_document_path)
+
+
+def prefetch_file(file_path: pathlib.Path):
+    """
+    Asks kernel to start reading file in background,
+    while writer thread is still busy with previously queued content.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        # missing file is reported by write_content
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def tar_writer_worker(backup: BackupContext, jobs: queue.Queue, errors: list[BaseException]):
+    """
+    Executes queued archive write jobs in order until None is received,
+    so database reads in the main thread overlap with archive writes.
+    After first error remaining jobs are discarded to not block producer.
+    """
+    job = jobs.get()
+    while job is not None:
+        if not len(errors):
+            try:
+                job(backup)
+            except BaseException as e:
+                errors.append(e)
+        job = jobs.get()
+
+
+def group_by_content_id(rows: list[tuple]) -> dict[int, list[tuple]]:
+    grouped_rows: dict[int, list[tuple]] = dict()
+    for row in rows:
+        if row[0] not in grouped_rows:
+            grouped_rows[row[0]] = [row]
+        else:
+            grouped_rows[row[0]].append(row)
+    return grouped_rows
 
 
 def main():
-    tar_dump = tarfile.TarFile("medialib-dump.tar", "w")
+    try:
+        from crcmod import _crcfunext
+    except ImportError:
+        logger.warning("crcmod C extension is not available, CRC-64 will be computed in pure Python")
+    generated_file_tar_info.mtime = int(time.time())
+    tar_file = open("medialib-dump.tar", "bw", buffering=TAR_WRITE_BUFFER_SIZE)
+    backup = BackupContext(tarfile.TarFile(fileobj=tar_file, mode="w", copybufsize=TAR_COPY_BUFFER_SIZE))
     tag_uniq_id: dict[TagUnique, int] = dict()
 
-    sql_get_content = "SELECT * FROM content order by RANDOM()"
-    sql_get_tag_ids = "SELECT tag_id FROM content_tags_list WHERE content_id=%s"
-    sql_get_tag = "SELECT * FROM tag WHERE ID=%s"
-    sql_get_tag_aliases = "SELECT title FROM tag_alias WHERE tag_id=%s"
-    sql_get_image_hash = (
-        "SELECT aspect_ratio, ENCODE(value_hash, 'hex'), hue_hash, saturation_hash, alternate_version "
-        "FROM imagehash WHERE content_id = %s"
+    sql_get_content = (
+        "SELECT id, file_path, title, content_type, description, addition_date, origin, origin_content_id, hidden, "
+        "ARRAY(SELECT tag_id FROM content_tags_list WHERE content_id = content.id) "
+        "FROM content order by RANDOM()"
     )
-    sql_get_representations = (
-        "SELECT * FROM representations WHERE content_id = %s"
+    sql_get_tags = "SELECT id, title, category, parent FROM tag"
+    sql_get_tags_aliases = "SELECT tag_id, title FROM tag_alias"
+    sql_get_image_hashes = (
+        "SELECT content_id, aspect_ratio, ENCODE(value_hash, 'hex'), hue_hash, saturation_hash, alternate_version "
+        "FROM imagehash"
     )
-    sql_get_album = (
-        "SELECT album.set_tag_id, album.album_artist_tag_id, album_order.order "
-        "FROM album_order JOIN album ON album_order.album_id = album.id "
-        "WHERE album_order.content_id = %s"
+    sql_get_representations = "SELECT * FROM representations"
+    sql_get_albums = (
+        "SELECT album_order.content_id, album.set_tag_id, album.album_artist_tag_id, album_order.order "
+        "FROM album_order JOIN album ON album_order.album_id = album.id"
     )
-    sql_get_alternate_sources = "SELECT origin, origin_content_id FROM alternate_sources WHERE content_id = %s"
+    sql_get_alternate_sources = "SELECT content_id, origin, origin_content_id FROM alternate_sources"
 
     connection = common.make_connection()
-    cursor = connection.cursor()
-
-    cursor.execute(sql_get_content, tuple())
-    raw_content_data = cursor.fetchall()
-
-    def tags_processing(tag_id, cursor) -> TagUnique:
-        global tags_uniq
-        global tag_documents
-
-        cursor.execute(sql_get_tag, (tag_id,))
-        tag_raw_data = cursor.fetchone()
-        tag_uniq = TagUnique(tag_raw_data[1], tag_raw_data[2])
-        if tag_uniq not in tags_uniq:
-            parent_tag_uniq = None
-            if tag_raw_data[3] is not None:
-                parent_tag_uniq = tags_processing(tag_raw_data[3], cursor)
-            cursor.execute(sql_get_tag_aliases, (tag_raw_data[0],))
-            tag_aliases = set([raw_alias[0] for raw_alias in cursor.fetchall()])
-            tag_document = TagDocument(
-                title=tag_raw_data[1],
-                category=tag_raw_data[2],
-                aliases=tag_aliases,
-                parent=parent_tag_uniq
-            )
-            tag_uniq_id[tag_uniq] = tag_id
-            tag_document_io = io.StringIO()
-            json.dump(tag_document.json_serializable(), tag_document_io)
-            tag_document_path = pathlib.PurePath("tags/{}.json".format(tag_id))
-            create_tar_file(tar_dump, tag_document_io, tag_document_path)
-            tags_uniq.add(tag_uniq)
-        return tag_uniq
-
-    for content in raw_content_data:
-        tags: set[TagUnique] = set()
-        content_id = content[0]
-        alternate_sources: list[AlternateSource] = []
-        cursor.execute(sql_get_tag_ids, (content_id,))
-        tag_ids = cursor.fetchall()
-        for tag_id_wrapped in tag_ids:
-            tags.add(tags_processing(tag_id_wrapped[0], cursor))
-        image_hash = None
-        cursor.execute(sql_get_image_hash, (content_id,))
-        image_hash_raw = cursor.fetchall()
-        if image_hash_raw is not None and len(image_hash_raw):
-            image_hash = ImageHash(
-                image_hash_raw[0][0],
-                image_hash_raw[0][1],
-                image_hash_raw[0][2],
-                image_hash_raw[0][3],
-                image_hash_raw[0][4]
-            )
-        representations = None
-        cursor.execute(sql_get_representations, (content_id,))
-        raw_representations = cursor.fetchall()
-        if raw_representations is not None and len(raw_representations):
-            representations = list()
-            for representations_raw_item in raw_representations:
-                representations.append(ContentRepresentationElement(
-                    representations_raw_item[1],
-                    representations_raw_item[2],
-                    pathlib.Path(representations_raw_item[3])
+    # tarfile is not thread-safe, so the writer thread is the only one using backup
+    tar_jobs: queue.Queue = queue.Queue(maxsize=32)
+    tar_writer_errors: list[BaseException] = []
+    tar_writer = threading.Thread(target=tar_writer_worker, args=(backup, tar_jobs, tar_writer_errors))
+    tar_writer.start()
+    try:
+        try:
+            cursor = connection.cursor()
+
+            cursor.execute(sql_get_tags, tuple())
+            raw_tags: dict[int, tuple] = {raw_tag[0]: raw_tag for raw_tag in cursor.fetchall()}
+            cursor.execute(sql_get_tags_aliases, tuple())
+            tags_aliases: dict[int, set[str]] = dict()
+            for raw_alias in cursor.fetchall():
+                if raw_alias[0] not in tags_aliases:
+                    tags_aliases[raw_alias[0]] = {raw_alias[1]}
+                else:
+                    tags_aliases[raw_alias[0]].add(raw_alias[1])
+
+            # per-content rows are loaded once and looked up by content ID,
+            # instead of four queries for every content item
+            cursor.execute(sql_get_image_hashes, tuple())
+            raw_image_hashes: dict[int, tuple] = {raw_hash[0]: raw_hash for raw_hash in cursor.fetchall()}
+            cursor.execute(sql_get_representations, tuple())
+            raw_representations_by_content = group_by_content_id(cursor.fetchall())
+            cursor.execute(sql_get_albums, tuple())
+            raw_albums_by_content = group_by_content_id(cursor.fetchall())
+            cursor.execute(sql_get_alternate_sources, tuple())
+            raw_alternate_sources_by_content = group_by_content_id(cursor.fetchall())
+
+            # server-side cursor streams content rows instead of loading the whole table
+            content_cursor = connection.cursor(name="backup_content")
+            content_cursor.itersize = 1000
+            content_cursor.execute(sql_get_content, tuple())
+
+            # tag ID to its label, presence also means tag document is already queued for writing
+            processed_tags: dict[int, TagUnique] = dict()
+
+            def tags_processing(tag_id) -> TagUnique:
+                if tag_id in processed_tags:
+                    return processed_tags[tag_id]
+                tag_raw_data = raw_tags[tag_id]
+                tag_uniq = TagUnique(tag_raw_data[1], tag_raw_data[2])
+                processed_tags[tag_id] = tag_uniq
+                parent_tag_uniq = None
+                if tag_raw_data[3] is not None:
+                    parent_tag_uniq = tags_processing(tag_raw_data[3])
+                tag_document = TagDocument(
+                    title=tag_raw_data[1],
+                    category=tag_raw_data[2],
+                    aliases=tags_aliases.get(tag_id, set()),
+                    parent=parent_tag_uniq
+                )
+                tag_uniq_id[tag_uniq] = tag_id
+                tag_document_path = "tags/{}.json".format(tag_id)
+                tar_jobs.put(functools.partial(
+                    create_tar_file,
+                    encoded_data=orjson.dumps(tag_document.json_serializable()),
+                    path=tag_document_path
                 ))
-        albums = None
-        cursor.execute(sql_get_album, (content_id,))
-        raw_albums = cursor.fetchall()
-        if raw_albums is not None and len(raw_albums):
-            albums = list()
-            for raw_album_item in raw_albums:
-                albums.append(AlbumOrder(
-                    tags_processing(raw_album_item[0], cursor),
-                    tags_processing(raw_album_item[1], cursor),
-                    raw_album_item[2]
+                return tag_uniq
+
+            for content in content_cursor:
+                tags: set[TagUnique] = set()
+                content_id = content[0]
+                alternate_sources: list[AlternateSource] = []
+                for tag_id in content[9]:
+                    tags.add(tags_processing(tag_id))
+                image_hash = None
+                image_hash_raw = raw_image_hashes.get(content_id)
+                if image_hash_raw is not None:
+                    image_hash = ImageHash(
+                        image_hash_raw[1],
+                        image_hash_raw[2],
+                        image_hash_raw[3],
+                        image_hash_raw[4],
+                        image_hash_raw[5]
+                    )
+                representations = None
+                raw_representations = raw_representations_by_content.get(content_id)
+                if raw_representations is not None:
+                    representations = list()
+                    for representations_raw_item in raw_representations:
+                        representations.append(ContentRepresentationElement(
+                            representations_raw_item[1],
+                            representations_raw_item[2],
+                            pathlib.Path(representations_raw_item[3])
+                        ))
+                albums = None
+                raw_albums = raw_albums_by_content.get(content_id)
+                if raw_albums is not None:
+                    albums = list()
+                    for raw_album_item in raw_albums:
+                        albums.append(AlbumOrder(
+                            tags_processing(raw_album_item[1]),
+                            tags_processing(raw_album_item[2]),
+                            raw_album_item[3]
+                        ))
+                for alt_src in raw_alternate_sources_by_content.get(content_id, ()):
+                    alternate_sources.append(AlternateSource(alt_src[1], alt_src[2]))
+
+                content_document = ContentDocument(
+                    content_id=content_id,
+                    file_path=pathlib.Path(content[1]),
+                    title=content[2],
+                    content_type=content[3],
+                    description=content[4],
+                    addition_date=content[5],
+                    origin=content[6],
+                    origin_content_id=content[7],
+                    is_hidden=content[8],
+                    tags=tags,
+                    imagehash=image_hash,
+                    representations=representations,
+                    albums=albums,
+                    alternate_sources=alternate_sources
+                )
+
+                content_document_data = orjson.dumps(content_document.json_serializable())
+                content_document_path = "content-metadata/{}.json".format(content_id)
+                prefetch_file(config.relative_to.joinpath(content_document.file_path))
+                tar_jobs.put(functools.partial(
+                    write_content,
+                    content_document=content_document,
+                    content_document_data=content_document_data,
+                    content_document_path=content_document_path
                 ))
-        cursor.execute(sql_get_alternate_sources, (content_id,))
-        alt_src = cursor.fetchone()
-        while alt_src is not None:
-            alternate_sources.append(AlternateSource(alt_src[0], alt_src[1]))
-
-            alt_src = cursor.fetchone()
-
-        content_document = ContentDocument(
-            content_id=content_id,
-            file_path=pathlib.Path(content[1]),
-            title=content[2],
-            content_type=content[3],
-            description=content[4],
-            addition_date=content[5],
-            origin=content[6],
-            origin_content_id=content[7],
-            is_hidden=content[8],
-            tags=tags,
-            imagehash=image_hash,
-            representations=representations,
-            albums=albums,
-            alternate_sources=alternate_sources
-        )
-
-        content_document_io = io.StringIO()
-        json.dump(content_document.json_serializable(), content_document_io)
-        content_document_path = pathlib.PurePath("content-metadata/{}.json".format(content_id))
-
-        try:
-            if content_document.file_path.suffix == ".srs":
-                write_srs(tar_dump, content_document.file_path, content_id)
-            elif content_document.file_path.suffix == ".mpd":
-                write_mpd(tar_dump, content_document.file_path, content_id)
-            else:
-                write_regular(tar_dump, content_document.file_path, content_id)
-        except FileNotFoundError as e:
-            print("Missing file \"{}\", content id = {}!".format(e.filename, content_id))
-        except xml.parsers.expat.ExpatError as e:
-            print("Invalid MPD file, content id = {}!".format(content_id))
-        else:
-            create_tar_file(tar_dump, content_document_io, content_document_path)
-    tag_uniq_id_io = io.StringIO()
-    tag_uniq_id_serialisable = []
-    for elem in tag_uniq_id:
-        _tag_uniq = dataclasses.astuple(elem)
-        tag_uniq_id_serialisable.append((_tag_uniq[0], _tag_uniq[1], tag_uniq_id[elem]))
-    json.dump(tag_uniq_id_serialisable, tag_uniq_id_io)
-    tag_uniq_id_filepath = pathlib.PurePath("tag_uniq_id.json")
-    create_tar_file(tar_dump, tag_uniq_id_io, tag_uniq_id_filepath)
-
-    checksums_io = io.StringIO()
-    for checksum in checksums:
-        checksums_io.write("{} {}\n".format(hex(checksum[0]).replace("0x", ""), checksum[1]))
-    checksums_filepath = pathlib.PurePath("checksums-crc64")
-    create_tar_file(tar_dump, checksums_io, checksums_filepath, write_crc=False)
-
-    tar_dump.close()
-    connection.close()
+                if len(tar_writer_errors):
+                    break
+            content_cursor.close()
+        finally:
+            # writer is stopped on errors too, so queued members are written before archive is closed
+            tar_jobs.put(None)
+            tar_writer.join()
+        if len(tar_writer_errors):
+            raise tar_writer_errors[0]
+
+        tag_uniq_id_serialisable = [
+            (tag_uniq.title, tag_uniq.category, tag_id) for tag_uniq, tag_id in tag_uniq_id.items()
+        ]
+        tag_uniq_id_filepath = "tag_uniq_id.json"
+        create_tar_file(backup, orjson.dumps(tag_uniq_id_serialisable), tag_uniq_id_filepath)
+
+        checksums_tar_info = copy.copy(generated_file_tar_info)
+        checksums_tar_info.name = "checksums-crc64"
+        checksums_tar_info.size = backup.checksums_file.tell()
+        backup.checksums_file.seek(0)
+        backup.tar_dump.addfile(checksums_tar_info, backup.checksums_file)
+    finally:
+        # archive is finished and flushed on errors too, instead of being left truncated
+        backup.checksums_file.close()
+        backup.tar_dump.close()
+        tar_file.close()
+        connection.close()
 
 
 if __name__ == "__main__":
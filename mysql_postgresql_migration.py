@@ -1,3 +1,5 @@
+import psycopg2.extras
+
 import common
 import tags_indexer
 
@@ -16,7 +18,6 @@ def main():
     tags_list = mysql_cursor.fetchall()
     mysql_get_tag_aliases = "SELECT title FROM tag_alias WHERE tag_id = %s"
     postgres_insert_tag_alias = "INSERT INTO tag_alias (tag_id, title) VALUES (%s, %s)"
-    postgres_get_tag_id = "SELECT id FROM tag WHERE title = %s and category = %s"
 
     exists_tags_list = set()
 
@@ -64,29 +65,31 @@ def main():
     mysql_get_tags_with_parents = (
         "SELECT title, category, parent FROM tag WHERE parent IS NOT NULL"
     )
-    mysql_get_tag_by_id = "SELECT title, category FROM tag WHERE ID = %s"
-    postgres_set_parent_tag = "UPDATE tag SET parent = %s WHERE id = %s"
+    postgres_get_all_tags = "SELECT id, title, category FROM tag"
+    postgres_set_parent_tag = (
+        "UPDATE tag SET parent = parent_tag.parent_id "
+        "FROM (VALUES %s) AS parent_tag (parent_id, tag_id) WHERE tag.id = parent_tag.tag_id"
+    )
+    # both tag tables are indexed once, parent links are resolved without per-tag queries
+    mysql_tags_by_id = {tag_data[0]: (tag_data[1], tag_data[2]) for tag_data in tags_list}
+    postgres_cursor.execute(postgres_get_all_tags, tuple())
+    postgres_tag_ids = {(tag_data[1], tag_data[2]): tag_data[0] for tag_data in postgres_cursor.fetchall()}
     mysql_cursor.execute(mysql_get_tags_with_parents, tuple())
     tags_with_parents = mysql_cursor.fetchall()
+    parent_tag_links = []
     for current_tag in tags_with_parents:
         current_category = current_tag[1]
         if current_category == "original character":
             current_category = "character"
-        postgres_cursor.execute(postgres_get_tag_id, (current_tag[0], current_category))
-        postgres_current_tag_id = postgres_cursor.fetchone()[0]
-        mysql_cursor.execute(mysql_get_tag_by_id, (current_tag[2],))
-        parent_tag_data = mysql_cursor.fetchone()
+        postgres_current_tag_id = postgres_tag_ids[(current_tag[0], current_category)]
+        parent_tag_data = mysql_tags_by_id[current_tag[2]]
         parent_tag_category = parent_tag_data[1]
         if parent_tag_category == "original character":
             parent_tag_category = "character"
-        postgres_cursor.execute(
-            postgres_get_tag_id, (parent_tag_data[0], parent_tag_category)
-        )
-        postgres_parent_tag_id = postgres_cursor.fetchone()[0]
-        postgres_cursor.execute(
-            postgres_set_parent_tag, (postgres_parent_tag_id, postgres_current_tag_id)
-        )
-        postgresql_connection.commit()
+        postgres_parent_tag_id = postgres_tag_ids[(parent_tag_data[0], parent_tag_category)]
+        parent_tag_links.append((postgres_parent_tag_id, postgres_current_tag_id))
+    psycopg2.extras.execute_values(postgres_cursor, postgres_set_parent_tag, parent_tag_links, page_size=1000)
+    postgresql_connection.commit()
 
     mysql_get_content = "SELECT * FROM content"
     mysql_cursor.execute(mysql_get_content, tuple())
@@ -98,11 +101,13 @@ def main():
     postgres_insert_content = (
         "INSERT INTO content "
         "(id, file_path, title, content_type, description, addition_date, origin, origin_content_id, hidden) "
-        "VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id"
+        "VALUES %s"
     )
+    postgres_insert_content_template = "(DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s)"
     # postgres_content_tag_connect = (
     #     "INSERT INTO content_tags_list (content_id, tag_id) VALUES (%s, %s)"
     # )
+    content_rows = []
     for raw_content_data in raw_content_list:
         content_data = []
         content_data.append(raw_content_data[1])
@@ -111,12 +116,16 @@ def main():
         )
         content_data.extend(raw_content_data[3:-1])
         content_data.append(bool(raw_content_data))
-        postgres_cursor.execute(
-            postgres_insert_content,
-            tuple(content_data)
-        )
-        postgres_content_id = postgres_cursor.fetchone()
-        postgresql_connection.commit()
+        content_rows.append(tuple(content_data))
+    # multi-row INSERT statements instead of a round-trip and a commit for every content item
+    psycopg2.extras.execute_values(
+        postgres_cursor,
+        postgres_insert_content,
+        content_rows,
+        template=postgres_insert_content_template,
+        page_size=1000
+    )
+    postgresql_connection.commit()
 
 
 if __name__ == "__main__":
@@ -1,4 +1,7 @@
+import functools
+import math
 import time
+import types
 
 import PIL.Image
 import torch
@@ -16,8 +19,50 @@ except ImportError:
     import common
 
 
-def make_clip_classification(
-        image: PIL.Image.Image, shared_state_list_proxy, results_pipe: multiprocessing.connection.Connection,
+# labels encoded by one text tower call
+TEXT_ENCODE_BATCH_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=1)
+def get_clip_model():
+    """
+    Loads CLIP model, its preprocessing transforms and tokenizer once per process.
+    """
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model, _, preprocess = open_clip.create_model_and_transforms(
+        'ViT-B-32-quickgelu', pretrained='laion400m_e32', device=device
+    )
+    model.eval()
+    dtype = torch.float32
+    if torch.cuda.is_available():
+        # half precision halves memory traffic and runs matmuls on tensor cores
+        dtype = torch.float16
+        model.half()
+    tokenizer = open_clip.get_tokenizer('ViT-B-32-quickgelu')
+    return device, dtype, model, preprocess, tokenizer
+
+
+# (tag ID, title) to normalized text features, tag titles change much rarer than images are classified
+text_features_cache: dict[tuple[int, str], torch.Tensor] = dict()
+
+
+def get_text_features(model, tokenizer, device, tags: list[tuple[int, str]], shared_state_list_proxy) -> torch.Tensor:
+    """
+    Encodes only tags missing in text_features_cache and returns features matrix in order of tags.
+    """
+    missing_tags = [tag for tag in tags if tag not in text_features_cache]
+    for batch_start in range(0, len(missing_tags), TEXT_ENCODE_BATCH_SIZE):
+        shared_state_list_proxy.done = batch_start
+        batch_tags = missing_tags[batch_start: batch_start + TEXT_ENCODE_BATCH_SIZE]
+        text = tokenizer([tag[1] for tag in batch_tags]).to(device)
+        text_features = model.encode_text(text)
+        text_features /= text_features.norm(dim=-1, keepdim=True)
+        text_features_cache.update(zip(batch_tags, text_features))
+    return torch.stack([text_features_cache[tag] for tag in tags])
+
+
+def clip_classification(
+        image: PIL.Image.Image, shared_state_list_proxy,
         tag_len_min=4,
         tag_len_max=8,
         max_tags_per_iteration=128,
@@ -27,75 +72,61 @@ def make_clip_classification(
     connection = common.make_connection()
     cursor = connection.cursor()
 
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
     sql_get_tag_names = (
         "SELECT id, title, category FROM tag where length(title) <= %s and length(title) >= %s "
         "and category != 'artist' and category != 'set';"
     )
     cursor.execute(sql_get_tag_names, (tag_len_max, tag_len_min))
 
-    model, _, preprocess = open_clip.create_model_and_transforms(
-        'ViT-B-32-quickgelu', pretrained='laion400m_e32', device=device
-    )
-    if torch.cuda.is_available():
-        model.cuda()
-    tokenizer = open_clip.get_tokenizer('ViT-B-32-quickgelu')
+    device, dtype, model, preprocess, tokenizer = get_clip_model()
 
-    _image = preprocess(image).unsqueeze(0).to(device)
+    _image = preprocess(image).unsqueeze(0).to(device, dtype=dtype)
     labels = []
     ids = []
     categories = []
-    image_features = model.encode_image(_image)
-    image_features /= image_features.norm(dim=-1, keepdim=True)
-
-    tag_name = cursor.fetchone()
-    while tag_name is not None:
-        labels.append(tag_name[1])
-        ids.append(tag_name[0])
-        categories.append(tag_name[2])
-        tag_name = cursor.fetchone()
+
+    for tag_id, tag_title, tag_category in cursor.fetchall():
+        labels.append(tag_title)
+        ids.append(tag_id)
+        categories.append(tag_category)
     cursor.close()
     connection.close()
 
-    current_iteration = 0
-    MAX_ITERATIONS = len(labels)
-    shared_state_list_proxy.total = MAX_ITERATIONS
-    results_list = []
-    while current_iteration < MAX_ITERATIONS:
-        shared_state_list_proxy.done = current_iteration
-        _labels = labels[current_iteration: current_iteration + max_tags_per_iteration]
-        _ids = ids[current_iteration: current_iteration + max_tags_per_iteration]
-        _categories = categories[current_iteration: current_iteration + max_tags_per_iteration]
-
-        text = tokenizer(_labels).to(device)
-
-        with torch.no_grad(), torch.cuda.amp.autocast():
-            text_features = model.encode_text(text)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
-            text_probs = (100.0 * image_features @ text_features.T).softmax(dim=-1)
-
-        results = zip(_ids, _labels, _categories, text_probs.tolist()[0])
-
-        results_list.extend(results)
+    tags_count = len(labels)
+    shared_state_list_proxy.total = tags_count
+    if not tags_count:
+        return []
+    with torch.inference_mode():
+        image_features = model.encode_image(_image)
+        image_features /= image_features.norm(dim=-1, keepdim=True)
+        text_features = get_text_features(
+            model, tokenizer, device, list(zip(ids, labels)), shared_state_list_proxy
+        )
+        logits = (100.0 * image_features @ text_features.T)[0].float()
+
+    # probabilities are normalized within groups of max_tags_per_iteration labels,
+    # padding logits with -inf keeps the last partial group the same size
+    padding = -tags_count % max_tags_per_iteration
+    text_probs = torch.nn.functional.pad(logits, (0, padding), value=-math.inf)
+    text_probs = text_probs.view(-1, max_tags_per_iteration).softmax(dim=-1).flatten()[:tags_count]
 
-        current_iteration += max_tags_per_iteration
+    if max_tags_count is not None:
+        top_probs, top_indexes = torch.topk(text_probs, min(max_tags_count, tags_count))
+    else:
+        top_probs, top_indexes = torch.sort(text_probs, descending=True)
 
-    def sort_results(e):
-        return e[3]
+    results_list = []
+    for probability, index in zip(top_probs.tolist(), top_indexes.tolist()):
+        if max_tags_count is not None and probability < min_tag_probability:
+            break
+        results_list.append((ids[index], labels[index], categories[index], probability))
+    return results_list
 
-    results_list.sort(key=sort_results, reverse=True)
 
-    if max_tags_count is not None:
-        filtered_results_list = []
-        for i in range(max_tags_count):
-            if results_list[i][3] >= min_tag_probability:
-                filtered_results_list.append(results_list[i])
-            else:
-                break
-        results_pipe.send(filtered_results_list)
-    else:
-        results_pipe.send(results_list)
+def make_clip_classification(
+        image: PIL.Image.Image, shared_state_list_proxy, results_pipe: multiprocessing.connection.Connection, **kwargs
+):
+    results_pipe.send(clip_classification(image, shared_state_list_proxy, **kwargs))
 
 
 def start_clip_classification_process(img: PIL.Image.Image):
@@ -118,6 +149,15 @@ def get_clip_classified_result(img: PIL.Image.Image):
     return result_pipe.recv()
 
 
+def get_clip_classified_result_in_process(img: PIL.Image.Image):
+    """
+    Classify image in the calling process, so model stays loaded between calls.
+    Caller keeps model (and GPU memory) resident and gets no progress reporting.
+    """
+    shared_state = types.SimpleNamespace(done=0, total=0)
+    return clip_classification(img, shared_state)
+
+
 if __name__ == '__main__':
     import pathlib
     import argparse
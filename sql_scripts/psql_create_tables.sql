@@ -28,8 +28,9 @@ create table tag
     title    varchar(240)   null,
     category T_CATEGORY     null,
     parent   bigint         null,
+    -- ID is included, so tag lookups by title and category are index-only scans
     constraint uniq_tag
-        unique (title, category),
+        unique (title, category) include (ID),
     constraint tag_ibfk_1
         foreign key (parent) references tag (ID)
 );
@@ -48,18 +49,27 @@ create table content_tags_list
     constraint uniq_keys UNIQUE (content_id, tag_id)
 );
 
+-- covers tag search subqueries (tag_id -> content_id) with index-only scans
+create index content_tags_list_tag_id_index
+    on content_tags_list (tag_id, content_id);
+
 create table tag_alias
 (
     tag_id bigint              not null,
     title  varchar(255)        not null,
+    -- tag_id is included, so tag ID lookups by alias are index-only scans
     constraint title
-        unique (title),
+        unique (title) include (tag_id),
     constraint tag_alias_FK
         foreign key (tag_id) references tag (ID)
 );
 
 create index tag_alias_index on tag_alias (title);
 
+-- trigram index serves wildcard_tag_search LIKE patterns, including ones with leading wildcard
+create extension if not exists pg_trgm;
+create index tag_alias_title_trgm_index on tag_alias using gin (title gin_trgm_ops);
+
 CREATE FUNCTION get_tags_ids (IN tag_alias_name varchar(255))
 RETURNS TABLE (id bigint)
 language sql as $$
@@ -1,13 +1,15 @@
 import base64
-import json
+import concurrent.futures
+import functools
 import argparse
 import logging
+import os
 import pathlib
 import dataclasses
+import weakref
 
-import psycopg2.errors
-
-import medialib_db.common
+import orjson
+import psycopg2.extras
 
 try:
     from . import config
@@ -28,14 +30,30 @@ import datetime
 logger = logging.getLogger(__name__)
 
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, slots=True)
 class ContentRepresentationUnit:
     file_path: pathlib.Path
     compatibility_level: int | None
     format: str
+    _relative_file_path: str | None = dataclasses.field(init=False, default=None, repr=False, compare=False)
+    _path_str: str | None = dataclasses.field(init=False, default=None, repr=False, compare=False)
+
+    def get_relative_file_path(self) -> str:
+        """
+        :rtype: file path relative to config.relative_to, as stored in database
+        """
+        # computed on first use, so files outside of config.relative_to still can be represented
+        if self._relative_file_path is None:
+            object.__setattr__(self, "_relative_file_path", str(self.file_path.relative_to(config.relative_to)))
+        return self._relative_file_path
 
     def get_path_str(self):
-        return base64.b32encode(str(self.file_path.relative_to(config.relative_to)).encode("utf-8")).decode("utf-8")
+        # base32 form is decoded back to path by consumers, so it is kept and computed once per instance
+        if self._path_str is None:
+            object.__setattr__(
+                self, "_path_str", base64.b32encode(self.get_relative_file_path().encode("utf-8")).decode("utf-8")
+            )
+        return self._path_str
 
 
 MEDIA_TYPE_CODES = {
@@ -53,43 +71,59 @@ def get_content_type(data):
 def srs_parse_representations(file_path: pathlib.Path) -> list[ContentRepresentationUnit]:
     parent_dir = file_path.parent
     results: list[ContentRepresentationUnit] = []
-    with file_path.open("r") as srs_file:
-        srs_data = json.load(srs_file)
-        if get_content_type(srs_data) == "image":
-            for level in srs_data["streams"]["image"]["levels"]:
-                repr_file_path = parent_dir.joinpath(srs_data["streams"]["image"]["levels"][level])
-                format = repr_file_path.suffix[1:].lower()
-                results.append(ContentRepresentationUnit(repr_file_path, int(level), format))
+    srs_data = orjson.loads(file_path.read_bytes())
+    if get_content_type(srs_data) == "image":
+        for level in srs_data["streams"]["image"]["levels"]:
+            repr_file_path = parent_dir.joinpath(srs_data["streams"]["image"]["levels"][level])
+            format = repr_file_path.suffix[1:].lower()
+            results.append(ContentRepresentationUnit(repr_file_path, int(level), format))
     return results
 
 
-def srs_update_representations(content_id, file_path, cursor):
+def srs_update_representations(content_id, file_path, cursor, compare_existing=True):
+    """
+    :param compare_existing: if False, content is just inserted and has no stored representations,
+        so they are inserted without comparing and removing
+    """
+    sql_get_representations = (
+        "SELECT format, compatibility_level, file_path FROM representations WHERE content_id=%s"
+    )
     sql_remove_representations = (
         "DELETE FROM representations WHERE content_id=%s"
     )
-    sql_insert_representation = (
-        "INSERT INTO representations (content_id, format, compatibility_level, file_path) "
-        "VALUES (%s, %s, %s, %s)"
+    sql_insert_representations = (
+        "INSERT INTO representations (content_id, format, compatibility_level, file_path) VALUES %s"
     )
-    cursor.execute(sql_remove_representations, (content_id,))
-    representations = srs_parse_representations(file_path)
-    for representation in representations:
-        cursor.execute(sql_insert_representation, (
-            content_id,
+    representations = [
+        (
             representation.format,
             representation.compatibility_level,
-            str(representation.file_path.relative_to(config.relative_to))
-        ))
-
-
-def deduplicate_tags(_tags: list[tuple[int, str, str]]) -> list[tuple[int, str, str]]:
-    tag_ids = set()
-    deduplicated = []
-    for tag in _tags:
-        if tag[0] not in tag_ids:
-            tag_ids.add(tag[0])
-            deduplicated.append(tag)
-    return deduplicated
+            representation.get_relative_file_path()
+        )
+        for representation in srs_parse_representations(file_path)
+    ]
+    if compare_existing:
+        cursor.execute(sql_get_representations, (content_id,))
+        stored_representations = cursor.fetchall()
+        # representations are rewritten only if they are changed
+        if len(stored_representations) == len(representations) and \
+                set(stored_representations) == set(representations):
+            return
+        cursor.execute(sql_remove_representations, (content_id,))
+    psycopg2.extras.execute_values(cursor, sql_insert_representations, [
+        (content_id, *representation) for representation in representations
+    ])
+
+
+# single multi-row statement for all tags of content, rows are expanded by execute_values
+sql_insert_content_tags = "INSERT INTO content_tags_list (content_id, tag_id) VALUES %s"
+
+# source tag category to database tag category and categories whose tag aliases are prefixed with category,
+# register() and index_file() get tags from different sources, so rules are different
+REGISTER_CATEGORY_REWRITE = {"characters": "character", "original character": "character"}
+REGISTER_ALIAS_PREFIX_CATEGORIES = frozenset(("artist", "copyright", "character"))
+INDEX_CATEGORY_REWRITE = {"characters": "character"}
+INDEX_ALIAS_PREFIX_CATEGORIES = frozenset(("artist", "set", "original character"))
 
 
 def register(
@@ -99,82 +133,75 @@ def register(
     Register content in medialib database
     :return: content ID
     """
-    cursor = connection.cursor()
-
-    _tags = set()
-
-    sql_check_tag_exists = "SELECT title, category FROM tag WHERE id = %s"
-
-    def verify_tag(tag_id, tag_name=None, tag_category=None):
-        cursor.execute(sql_check_tag_exists, (tag_id,))
-        tag_verify_data = cursor.fetchone()
-        if tag_verify_data is None:
-            if tag_name is not None and tag_category is not None:
-                raise Exception(
-                    "Inserted tag {}({}) actually does\'t exists".format(tag_name, tag_category)
-                )
-            else:
+    with connection.cursor() as cursor:
+        # tag ID to tag, keeps first seen tag for every ID
+        _tags: dict[int, tuple[int, str, str]] = dict()
+
+        # tag alias to tag name, category and source category, repeated tags are collapsed before database lookups
+        requested_tags: dict[str, tuple[str, str, str]] = dict()
+        for tag_category in tags:
+            _category = REGISTER_CATEGORY_REWRITE.get(tag_category, tag_category)
+            alias_prefixed = tag_category in REGISTER_ALIAS_PREFIX_CATEGORIES
+            for tag_name in tags[tag_category]:
+                tag_alias = f"{tag_category}:{tag_name}" if alias_prefixed else tag_name
+                requested_tags.setdefault(tag_alias, (tag_name, _category, tag_category))
+        # all known aliases are resolved by one query, new tags are inserted with single commit
+        known_tag_ids = tags_indexer.get_tag_ids_by_aliases(requested_tags.keys(), connection)
+        new_tag_aliases = [tag_alias for tag_alias in requested_tags if tag_alias not in known_tag_ids]
+        if len(new_tag_aliases):
+            new_tag_ids = tags_indexer.insert_new_tags([
+                (requested_tags[tag_alias][0], requested_tags[tag_alias][1], tag_alias)
+                for tag_alias in new_tag_aliases
+            ], connection)
+            known_tag_ids.update(zip(new_tag_aliases, new_tag_ids))
+        for tag_alias, (tag_name, _category, tag_category) in requested_tags.items():
+            tag_id = known_tag_ids[tag_alias]
+            logger.debug("tag_id={}".format(tag_id.__repr__()))
+            _tags.setdefault(tag_id, (tag_id, tag_name, _category))
+        # all resolved and inserted tags are verified by one query
+        sql_check_tags_exist = "SELECT id, title, category FROM tag WHERE id = ANY(%s)"
+        cursor.execute(sql_check_tags_exist, (list(_tags),))
+        existing_tags = {tag_data[0]: tag_data for tag_data in cursor.fetchall()}
+        for tag_id, (_, tag_name, _category) in _tags.items():
+            if tag_id not in existing_tags:
                 raise Exception(
-                    "Inserted tag id{} actually does\'t exists".format(tag_id)
+                    "Inserted tag {}({}) actually does\'t exists".format(tag_name, _category)
                 )
-        else:
-            logger.debug("Tag exists: {}({})".format(tag_verify_data[0], tag_verify_data[1]))
-
-    for tag_category in tags:
-        _category = tag_category
-        if tag_category == "characters" or tag_category == "original character":
-            _category = "character"
-        for tag in tags[tag_category]:
-            tag_name = tag
-            tag_alias = tag
-            for special_tag_category in ("artist", "copyright", "character"):
-                if tag_category == special_tag_category:
-                    tag_alias = "{}:{}".format(special_tag_category, tag_name)
-            tag_id = medialib_db.tags_indexer.get_tag_id_by_alias(
-                tag_alias, connection
-            )
-            logger.debug("tag_id={}".format(tag_id.__repr__()))
-            if tag_id is None:
-                tag_id = tags_indexer.insert_new_tag(tag_name, _category, tag_alias, connection)
-                verify_tag(tag_id, tag_name, tag_category)
-            else:
-                if type(tag_id) is tuple:
-                    tag_id = tag_id[0]
-            _tags.add((tag_id, tag_name, _category))
-    sql_insert_content_query = (
-        "INSERT INTO content "
-        "(id, file_path, title, content_type, description, addition_date, origin, origin_content_id, hidden) "
-        "VALUES (DEFAULT, %s, %s, %s, %s, NOW(), %s, %s, FALSE) RETURNING id"
-    )
-    try:
+        if logger.isEnabledFor(logging.DEBUG):
+            for _, title, category in existing_tags.values():
+                logger.debug("Tag exists: {}({})".format(title, category))
+        sql_insert_content_query = (
+            "INSERT INTO content "
+            "(id, file_path, title, content_type, description, addition_date, origin, origin_content_id, hidden) "
+            "VALUES (DEFAULT, %s, %s, %s, %s, NOW(), %s, %s, FALSE) "
+            "ON CONFLICT (file_path) DO NOTHING RETURNING id"
+        )
         cursor.execute(
             sql_insert_content_query,
             (
                 str(file_path.relative_to(config.relative_to)),
-                medialib_db.common.postgres_string_format(title, common.CONTENT_TITLE_MAX_SIZE),
+                common.postgres_string_format(title, common.CONTENT_TITLE_MAX_SIZE),
                 media_type,
                 description,
                 origin,
                 content_id
             )
         )
-    except psycopg2.errors.UniqueViolation:
-        # triggers in same file path case (file exists)
-        return
-    content_id = cursor.fetchone()[0]
-    sql_insert_content_id_to_tag_id = "INSERT INTO content_tags_list (content_id, tag_id) VALUES (%s, %s)"
-
-    _tags = deduplicate_tags(_tags)
-
-    for tag in _tags:
-        verify_tag(tag[0])
-        cursor.execute(sql_insert_content_id_to_tag_id, (content_id, tag[0]))
+        inserted_content = cursor.fetchone()
+        if inserted_content is None:
+            # same file path case (file exists), transaction stays usable
+            return
+        content_id = inserted_content[0]
+
+        psycopg2.extras.execute_values(
+            cursor, sql_insert_content_tags, [(content_id, tag_id) for tag_id in _tags], page_size=500
+        )
 
-    if file_path.suffix == ".srs":
-        srs_update_representations(content_id, file_path, cursor)
+        if file_path.suffix == ".srs":
+            srs_update_representations(content_id, file_path, cursor, compare_existing=False)
 
-    connection.commit()
-    return content_id
+        connection.commit()
+        return content_id
 
 
 def index(file_path: pathlib.Path, description=None, auto_open_connection=True):
@@ -182,79 +209,130 @@ def index(file_path: pathlib.Path, description=None, auto_open_connection=True):
         common.open_connection_if_not_opened()
     elif common.connection is None:
         raise OSError("connection is closed")
-    cursor = common.connection.cursor()
-    sql_check_indexed = "SELECT COUNT(*) FROM content WHERE file_path = %s"
-    cursor.execute(sql_check_indexed, (str(file_path.relative_to(config.relative_to)),))
-    if cursor.fetchone()[0] > 0:
-        print("File exists, skipped")
-        if auto_open_connection:
-            common.close_connection_if_not_closed()
-        return
-    f = file_path.open("r")
-    data = json.load(f)
-    f.close()
-    if 'tags' not in data['content']:
-        if auto_open_connection:
-            common.close_connection_if_not_closed()
-        return
-    media_type = get_content_type(data)
-    content_title = None
-    if "title" in data['content'] and data['content']['title'] is not None:
-        content_title = data['content']['title']
-    mtime = datetime.datetime.fromtimestamp(file_path.stat().st_mtime)
-    tags = list()
-    origin_name = None
-    if "origin" in data['content'] and data['content']['origin'] is not None:
-        origin_name = data['content']['origin']
-    origin_id = None
-    if "id" in data['content'] and data['content']['id'] is not None:
-        origin_id = str(data['content']['id'])
-    for tag_category in data['content']['tags']:
-        _category = tag_category
-        if tag_category == "characters":
-            _category = "character"
-        for tag in data['content']['tags'][tag_category]:
-            tag_name = tag
-            tag_alias = tag
-            for special_tag_category in ("artist", "set", "original character"):
-                if tag_category == special_tag_category:
-                    tag_alias = "{}:{}".format(special_tag_category, tag_name)
-            tag_id = tags_indexer.check_tag_exists(tag_name, _category, connection=common.connection)
-            if tag_id is None:
-                tag_id = tags_indexer.insert_new_tag(
-                    tag_name, _category, tag_alias, connection=common.connection
-                )
-            else:
-                tag_id = tag_id[0]
-            tags.append((tag_id, tag_name, _category))
-    sql_insert_content_query = (
-        "INSERT INTO content "
-        "(id, file_path, title, content_type, description, addition_date, origin, origin_content_id, hidden)"
-        " VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, FALSE) RETURNING id"
-    )
-    cursor.execute(
-        sql_insert_content_query,
-        (
-            str(file_path.relative_to(config.relative_to)),
-            content_title,
-            media_type,
-            description,
-            mtime,
-            origin_name,
-            origin_id
+    index_file(file_path, common.connection, description)
+    if auto_open_connection:
+        common.close_connection_if_not_closed()
+
+
+sql_prepare_index_statements = (
+    "PREPARE mdb_check_indexed AS SELECT 1 FROM content WHERE file_path = $1 LIMIT 1;"
+    "PREPARE mdb_insert_indexed_content AS INSERT INTO content "
+    "(id, file_path, title, content_type, description, addition_date, origin, origin_content_id, hidden)"
+    " VALUES (DEFAULT, $1, $2, $3, $4, $5, $6, $7, FALSE) RETURNING id;"
+)
+# pooled connections live across many index_file calls, statements are prepared once for each
+_index_prepared_connections = weakref.WeakSet()
+
+
+def _prepare_index_statements(connection):
+    if connection not in _index_prepared_connections:
+        with connection.cursor() as cursor:
+            cursor.execute(sql_prepare_index_statements)
+        _index_prepared_connections.add(connection)
+
+
+def index_file(
+        file_path: pathlib.Path, connection, description=None, tag_ids_cache=None, synchronous_commit=True
+        ):
+    """
+    Index SRS file using given connection, so files can be indexed concurrently with own connections.
+    :param tag_ids_cache: (tag name, category) to tag ID dictionary shared by files indexed in one run,
+        so recurring tags are resolved once
+    :param synchronous_commit: if False, content commit does not wait for WAL flush
+    """
+    _prepare_index_statements(connection)
+    with connection.cursor() as cursor:
+        relative_file_path = str(file_path.relative_to(config.relative_to))
+        sql_check_indexed = "EXECUTE mdb_check_indexed(%s)"
+        cursor.execute(sql_check_indexed, (relative_file_path,))
+        if cursor.fetchone() is not None:
+            print("File exists, skipped")
+            return
+        # stat is taken from opened file, so file is not looked up again for mtime
+        with file_path.open("rb") as srs_file:
+            srs_file_stat = os.fstat(srs_file.fileno())
+            data = orjson.loads(srs_file.read())
+        if 'tags' not in data['content']:
+            return
+        media_type = get_content_type(data)
+        content_title = None
+        if "title" in data['content'] and data['content']['title'] is not None:
+            content_title = data['content']['title']
+        mtime = datetime.datetime.fromtimestamp(srs_file_stat.st_mtime)
+        tags: dict[int, tuple[int, str, str]] = dict()
+        origin_name = None
+        if "origin" in data['content'] and data['content']['origin'] is not None:
+            origin_name = data['content']['origin']
+        origin_id = None
+        if "id" in data['content'] and data['content']['id'] is not None:
+            origin_id = str(data['content']['id'])
+        # (tag name, category) to tag alias, repeated tags are collapsed before database lookups
+        requested_tags: dict[tuple[str, str], str] = dict()
+        for tag_category in data['content']['tags']:
+            _category = INDEX_CATEGORY_REWRITE.get(tag_category, tag_category)
+            alias_prefixed = tag_category in INDEX_ALIAS_PREFIX_CATEGORIES
+            for tag_name in data['content']['tags'][tag_category]:
+                tag_alias = f"{tag_category}:{tag_name}" if alias_prefixed else tag_name
+                requested_tags.setdefault((tag_name, _category), tag_alias)
+        known_tag_ids = tag_ids_cache if tag_ids_cache is not None else dict()
+        not_cached_tags = [tag_key for tag_key in requested_tags if tag_key not in known_tag_ids]
+        if len(not_cached_tags):
+            known_tag_ids.update(tags_indexer.check_tags_exist(not_cached_tags, connection=connection))
+        new_tags = [tag_key for tag_key in requested_tags if tag_key not in known_tag_ids]
+        if len(new_tags):
+            new_tag_ids = tags_indexer.insert_new_tags(
+                [(tag_name, _category, requested_tags[(tag_name, _category)]) for tag_name, _category in new_tags],
+                connection=connection
+            )
+            known_tag_ids.update(zip(new_tags, new_tag_ids))
+        for (tag_name, _category), tag_alias in requested_tags.items():
+            tag_id = known_tag_ids[(tag_name, _category)]
+            tags.setdefault(tag_id, (tag_id, tag_name, _category))
+        if not synchronous_commit:
+            # new tags are committed by insert_new_tags, so setting is applied to content transaction only
+            cursor.execute("SET LOCAL synchronous_commit TO OFF")
+        sql_insert_content_query = "EXECUTE mdb_insert_indexed_content(%s, %s, %s, %s, %s, %s, %s)"
+        cursor.execute(
+            sql_insert_content_query,
+            (
+                relative_file_path,
+                content_title,
+                media_type,
+                description,
+                mtime,
+                origin_name,
+                origin_id
+            )
         )
-    )
-    content_id = cursor.fetchone()[0]
-    sql_insert_content_id_to_tag_id = "INSERT INTO content_tags_list (content_id, tag_id) VALUES (%s, %s)"
+        content_id = cursor.fetchone()[0]
 
-    tags = deduplicate_tags(tags)
+        psycopg2.extras.execute_values(
+            cursor, sql_insert_content_tags, [(content_id, tag_id) for tag_id in tags], page_size=500
+        )
 
-    for tag in tags:
-        cursor.execute(sql_insert_content_id_to_tag_id, (content_id, tag[0]))
+        connection.commit()
+
+
+INDEX_WORKERS = min(getattr(config, "db_pool_max_connections", 16), os.cpu_count() or 1)
 
-    common.connection.commit()
-    if auto_open_connection:
-        common.close_connection_if_not_closed()
+
+def index_pooled(file_path: pathlib.Path, tag_ids_cache: dict[tuple[str, str], int]) -> pathlib.Path:
+    try:
+        with common.pooled_connection() as connection:
+            # directory indexing is repeatable and verify_exists runs before it,
+            # so per-file commits do not wait for disk sync
+            index_file(file_path, connection, tag_ids_cache=tag_ids_cache, synchronous_commit=False)
+    except Exception:
+        # one broken file should not stop indexing of the rest
+        logger.exception("Failed to index file %s", file_path)
+    return file_path
+
+
+VERIFY_EXISTS_WORKERS = 32
+
+
+def content_file_exists(relative_file_path: str) -> bool:
+    return config.relative_to.joinpath(relative_file_path).exists()
 
 
 def verify_exists(auto_open_connection=True):
@@ -263,24 +341,29 @@ def verify_exists(auto_open_connection=True):
     elif common.connection is None:
         raise OSError("connection is closed")
     print("Verifying file existing…")
-    cursor = common.connection.cursor()
-    sql_get_file_paths = "SELECT file_path FROM content"
-    cursor.execute(sql_get_file_paths)
-    deleted_list = list()
-    relative_file_path = cursor.fetchone()
-    while relative_file_path is not None:
-        file_path = config.relative_to.joinpath(relative_file_path[0])
-        if not file_path.exists():
-            deleted_list.append(relative_file_path[0])
-        relative_file_path = cursor.fetchone()
-
-    for file in deleted_list:
-        print(file)
-        sql_delete_tags = \
-            "DELETE FROM content_tags_list WHERE content_id = (SELECT id FROM content WHERE file_path = %s)"
-        cursor.execute(sql_delete_tags, (file,))
-        sql_delete_file_query = "DELETE FROM content WHERE file_path = %s"
-        cursor.execute(sql_delete_file_query, (file,))
+    # server-side cursor fetches paths by batches instead of loading whole content table
+    with common.connection.cursor(name="verify_content_paths") as paths_cursor:
+        paths_cursor.itersize = 10000
+        sql_get_file_paths = "SELECT id, file_path FROM content"
+        paths_cursor.execute(sql_get_file_paths)
+        deleted_ids = list()
+        # stat() calls block on disk, so every fetched batch of paths is checked concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=VERIFY_EXISTS_WORKERS) as executor:
+            rows = paths_cursor.fetchmany(paths_cursor.itersize)
+            while len(rows):
+                files_exists = executor.map(content_file_exists, (row[1] for row in rows))
+                for (content_id, relative_file_path), file_exists in zip(rows, files_exists):
+                    if not file_exists:
+                        print(relative_file_path)
+                        deleted_ids.append(content_id)
+                rows = paths_cursor.fetchmany(paths_cursor.itersize)
+
+    if len(deleted_ids):
+        with common.connection.cursor() as cursor:
+            sql_delete_tags = "DELETE FROM content_tags_list WHERE content_id = ANY(%s)"
+            cursor.execute(sql_delete_tags, (deleted_ids,))
+            sql_delete_file_query = "DELETE FROM content WHERE id = ANY(%s)"
+            cursor.execute(sql_delete_file_query, (deleted_ids,))
 
     common.connection.commit()
     if auto_open_connection:
@@ -294,9 +377,14 @@ if __name__ == '__main__':
     common.open_connection_if_not_opened()
     verify_exists(auto_open_connection=False)
     if pathlib.Path(args.path).is_dir():
-        for file in args.path.glob("**/*.srs"):
-            print("Processing file ", file)
-            index(file, auto_open_connection=False)
+        common.close_connection_if_not_closed()
+        # every worker thread indexes files with its own connection from pool
+        # tags are only added during indexing, so IDs resolved once stay valid for the whole run
+        tag_ids_cache: dict[tuple[str, str], int] = dict()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=INDEX_WORKERS) as executor:
+            _index_pooled = functools.partial(index_pooled, tag_ids_cache=tag_ids_cache)
+            for file in executor.map(_index_pooled, args.path.glob("**/*.srs")):
+                print("Processed file ", file)
     elif pathlib.Path(args.path).is_file():
         index(args.path, auto_open_connection=False)
     common.close_connection_if_not_closed()
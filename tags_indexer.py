@@ -1,6 +1,7 @@
 import logging
-import psycopg2.errors
-import re
+import weakref
+
+from typing import Iterator
 
 import psycopg2
 
@@ -16,6 +17,66 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# frequent tag lookups are parsed and planned once per connection, functions run them by EXECUTE
+sql_prepare_tag_statements = (
+    # tag title match has priority over alias match, both are probed by one statement
+    "PREPARE mdb_tag_by_title_or_alias AS SELECT ID FROM ("
+    "SELECT ID, 0 AS priority FROM tag WHERE title=$1 and category=$2 "
+    "UNION ALL "
+    "SELECT ID, 1 AS priority FROM tag "
+    "WHERE id = (SELECT tag_id FROM tag_alias WHERE tag_alias.title = $1) and category=$2"
+    ") AS found_tags ORDER BY priority LIMIT 1;"
+    # categories of tags with given title, or of tag with given alias if there are no such titles,
+    # category is cast to text, so psycopg2 parses array into list
+    "PREPARE mdb_categories_of_tag AS "
+    "WITH by_title AS (SELECT category FROM tag WHERE title = $1) "
+    "SELECT array_agg(DISTINCT category::text) FROM ("
+    "SELECT category FROM by_title "
+    "UNION ALL "
+    "SELECT category FROM tag where id = (SELECT tag_id FROM tag_alias where title = $1) "
+    "AND NOT EXISTS (SELECT 1 FROM by_title)"
+    ") AS categories;"
+    "PREPARE mdb_tag_info AS SELECT * FROM tag where ID=$1;"
+    # lists are aggregated by database and returned as single array value
+    "PREPARE mdb_tag_aliases AS SELECT array_agg(title) FROM tag_alias where tag_id=$1;"
+    "PREPARE mdb_content_ids_by_tag AS SELECT array_agg(content_id) FROM content_tags_list where tag_id = $1;"
+    "PREPARE mdb_tag_id_by_alias AS SELECT tag_id FROM tag_alias WHERE title=$1;"
+)
+_tag_statements_prepared_connections = weakref.WeakSet()
+
+
+def _prepare_tag_statements(connection):
+    if connection not in _tag_statements_prepared_connections:
+        with connection.cursor() as cursor:
+            cursor.execute(sql_prepare_tag_statements)
+        _tag_statements_prepared_connections.add(connection)
+
+
+class TagSession:
+    """
+    Groups several tag mutations into one transaction, so they are flushed by single commit.
+    Mutators inside session should be called with commit=False:
+
+        with TagSession(connection):
+            for alias in aliases:
+                add_alias(tag_id, alias, connection, commit=False)
+
+    Transaction is committed on exit or rolled back if exception raised,
+    mutators called with commit=False never roll back by themselves, so session is all or nothing.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.commit()
+        else:
+            self.connection.rollback()
+        return False
+
 
 def _request(request_body, *args, connection):
     #print(connection, args)
@@ -23,18 +84,15 @@ def _request(request_body, *args, connection):
     return request_body(cursor, *args)
 
 
-def _check_tag_exists(cursor, tag_name: str, tag_category: str):
-    sql_select_tag_query = "SELECT ID FROM tag WHERE title=%s and category=%s"
-    _tag_name = tag_name.replace("_", " ")
+def _check_tag_exists(cursor, _tag_name: str, tag_category: str):
+    """
+    :param _tag_name: tag name with underscores already replaced by spaces
+    """
+    _prepare_tag_statements(cursor.connection)
+    sql_select_tag_query = "EXECUTE mdb_tag_by_title_or_alias(%s, %s)"
     logger.debug("query=\"{}\" title=\"{}\" category=\"{}\"".format(sql_select_tag_query, _tag_name, tag_category))
     cursor.execute(sql_select_tag_query, (_tag_name, tag_category))
-    id = cursor.fetchone()
-    if id is None:
-        sql_get_id_of_alias = \
-            "SELECT ID FROM tag WHERE id = (SELECT tag_id FROM tag_alias WHERE tag_alias.title = %s) and category=%s"
-        cursor.execute(sql_get_id_of_alias, (_tag_name, tag_category))
-        id = cursor.fetchone()
-    return id
+    return cursor.fetchone()
 
 
 def check_tag_exists(tag_name, tag_category, connection) -> tuple[int,]:
@@ -42,10 +100,10 @@ def check_tag_exists(tag_name, tag_category, connection) -> tuple[int,]:
     Check exists tag in specified category and returns tag ID.
     :rtype: tuple with ID of tag (tuple(int,))
     """
-    return _request(_check_tag_exists, tag_name, tag_category, connection=connection)
+    return _request(_check_tag_exists, tag_name.replace("_", " "), tag_category, connection=connection)
 
 
-def _insert_new_tag(connection, tag_name: str, tag_category, tag_alias=None):
+def _insert_new_tag(connection, tag_name: str, tag_category, tag_alias=None, commit=True):
     cursor = connection.cursor()
     if tag_alias is None:
         tag_alias = tag_name
@@ -54,24 +112,39 @@ def _insert_new_tag(connection, tag_name: str, tag_category, tag_alias=None):
         elif tag_category == "artist":
             tag_alias = "artist:{}".format(tag_name)
     _tag_name = tag_name.replace("_", " ")
-    sql_insert_tag_query = "INSERT INTO tag (id, title, category) VALUES (DEFAULT, %s, %s) RETURNING id"
-    try:
-        cursor.execute(sql_insert_tag_query, (_tag_name, tag_category))
-    except psycopg2.errors.UniqueViolation:
-        connection.rollback()
-        return _check_tag_exists(cursor, _tag_name, tag_category)
-    tag_id = cursor.fetchone()[0]
+    sql_insert_tag_query = (
+        "INSERT INTO tag (id, title, category) VALUES (DEFAULT, %s, %s) "
+        "ON CONFLICT (title, category) DO NOTHING RETURNING id"
+    )
+    cursor.execute(sql_insert_tag_query, (_tag_name, tag_category))
+    inserted_tag = cursor.fetchone()
+    if inserted_tag is None:
+        # tag already exists, transaction is not aborted by conflict, so no rollback needed
+        return _check_tag_exists(cursor, _tag_name, tag_category)[0]
+    tag_id = inserted_tag[0]
     logger.debug("_insert_new_tag last row id={}".format(tag_id))
-    sql_insert_alias_query = "INSERT INTO tag_alias (tag_id, title) VALUES (%s, %s)"
     logger.debug("tag {} ({}) alias insert: {} ".format(
         _tag_name,
         tag_category,
         tag_alias
     ))
-    try:
-        cursor.execute(sql_insert_alias_query, (tag_id, tag_alias))
-    except psycopg2.IntegrityError as e:
-        cursor.connection.rollback()
+    # variant of alias with spaces and underscores swapped
+    alias_variant = None
+    if " " in tag_alias:
+        alias_variant = tag_alias.replace(" ", "_")
+    elif "_" in tag_alias:
+        alias_variant = tag_alias.replace("_", " ")
+    # both aliases are inserted by one statement, variant is inserted only if alias is not taken by other tag
+    sql_insert_aliases_query = (
+        "WITH inserted_alias AS ("
+        "INSERT INTO tag_alias (tag_id, title) VALUES (%s, %s) ON CONFLICT (title) DO NOTHING RETURNING tag_id"
+        "), inserted_variant AS ("
+        "INSERT INTO tag_alias (tag_id, title) SELECT tag_id, %s FROM inserted_alias WHERE %s IS NOT NULL"
+        ") SELECT tag_id FROM inserted_alias"
+    )
+    cursor.execute(sql_insert_aliases_query, (tag_id, tag_alias, alias_variant, alias_variant))
+    if cursor.fetchone() is None:
+        # alias belongs to another tag
         get_tag_info = (
             "SELECT tag.category, ID from tag "
             "where id=(SELECT tag_id from tag_alias where tag_alias.title=%s)"
@@ -89,41 +162,49 @@ def _insert_new_tag(connection, tag_name: str, tag_category, tag_alias=None):
         elif tag_category == "content":
             return tag_id
         else:
-            raise e
-    if " " in tag_alias:
-        cursor.execute(sql_insert_alias_query, (tag_id, tag_alias.replace(" ", "_")))
-    elif "_" in tag_alias:
-        cursor.execute(sql_insert_alias_query, (tag_id, tag_alias.replace("_", " ")))
-    connection.commit()
+            if commit:
+                connection.rollback()
+            # otherwise transaction belongs to caller, which rolls it back with its own changes
+            raise psycopg2.IntegrityError("tag alias \"{}\" already exists".format(tag_alias))
+    if commit:
+        connection.commit()
     return tag_id
 
 
-def insert_new_tag(tag_name, tag_category, tag_alias, connection) -> int:
+def insert_new_tag(tag_name, tag_category, tag_alias, connection, commit=True) -> int:
     """
     Insert new tag in database's table and returns tag ID.
+    :param commit: if False, caller commits, so several changes share one transaction
     :rtype: ID of tag (int)
     """
-    return _insert_new_tag(connection, tag_name, tag_category, tag_alias)
-
-
-def _get_category_of_tag(cursor, tag_name):
-    def mysql_escafe_quotes(_string):
-        return re.sub("\"", "\\\"", _string)
-
-    get_tag_category_query = "SELECT category FROM tag WHERE title = %s;"
-    cursor.execute(get_tag_category_query, (tag_name.replace("_", " "),))
-    raw_categories = cursor.fetchall()
-    if len(raw_categories) == 0 or raw_categories is None:
-        get_tag_category_by_alias = \
-            "SELECT category FROM tag where id = (SELECT tag_id FROM tag_alias where title = %s)"
-        cursor.execute(get_tag_category_by_alias, (tag_name.replace("_", " "),))
-        raw_categories = cursor.fetchall()
-    if raw_categories is not None:
-        categories_list = set()
-        for raw_category in raw_categories:
-            categories_list.add(raw_category[0])
-        if len(categories_list):
-            return categories_list
+    return _insert_new_tag(connection, tag_name, tag_category, tag_alias, commit=commit)
+
+
+def insert_new_tags(tags: list[tuple[str, str, str]], connection) -> list[int]:
+    """
+    Insert several new tags in one transaction with single commit,
+    if any tag fails, none of them is inserted.
+    :param tags: list of (tag name, tag category, tag alias)
+    :rtype: IDs of tags in order of given tags (list[int])
+    """
+    with TagSession(connection):
+        tag_ids = [
+            _insert_new_tag(connection, tag_name, tag_category, tag_alias, commit=False)
+            for tag_name, tag_category, tag_alias in tags
+        ]
+    return tag_ids
+
+
+def _get_category_of_tag(cursor, _tag_name):
+    """
+    :param _tag_name: tag name with underscores already replaced by spaces
+    """
+    _prepare_tag_statements(cursor.connection)
+    get_tag_category_query = "EXECUTE mdb_categories_of_tag(%s)"
+    cursor.execute(get_tag_category_query, (_tag_name,))
+    raw_categories = cursor.fetchone()[0]
+    if raw_categories:
+        return set(raw_categories)
     return None
 
 
@@ -132,21 +213,51 @@ def get_category_of_tag(tag_name, connection):
     Return category of tag, if exists
     :rtype: str(enum(tag_categories))
     """
-    return _request(_get_category_of_tag, tag_name, connection=connection)
+    return _request(_get_category_of_tag, tag_name.replace("_", " "), connection=connection)
 
-def wildcard_tag_search(wildcard_string:str, connection):
-    sql_tag_alias_search = (
-        "SELECT * FROM tag_alias WHERE title like %s"
-    )
+# served by trigram index tag_alias_title_trgm_index (pg_trgm), so leading wildcards do not scan whole table
+sql_tag_alias_search = (
+    "SELECT * FROM tag_alias WHERE title like %s LIMIT %s"
+)
+
+
+def wildcard_tag_search(wildcard_string:str, connection, limit: int | None = None):
+    """
+    Search aliases by wildcard pattern, "*" matches any substring.
+    Requires tag_alias_title_trgm_index (pg_trgm) from psql_create_tables.sql,
+    otherwise patterns with leading "*" scan whole tag_alias table.
+    :param limit: maximum count of returned aliases, None returns all matches
+    """
     cursor = connection.cursor()
     sql_wildcard_string = wildcard_string.replace("*", "%")
-    cursor.execute(sql_tag_alias_search, (sql_wildcard_string,))
+    # LIMIT NULL means no limit in PostgreSQL
+    cursor.execute(sql_tag_alias_search, (sql_wildcard_string, limit))
     result = cursor.fetchall()
     cursor.close()
     return result
 
+
+WILDCARD_SEARCH_ITERSIZE = 2000
+
+
+def iter_wildcard_tag_search(
+        wildcard_string: str, connection, limit: int | None = None
+) -> Iterator[tuple[int, str]]:
+    """
+    Lazy version of wildcard_tag_search, rows are streamed by server-side cursor in batches,
+    so broad wildcards are not loaded to memory at once.
+    :param limit: maximum count of returned aliases, None returns all matches
+    :rtype: iterator of (tag ID, alias title)
+    """
+    sql_wildcard_string = wildcard_string.replace("*", "%")
+    with connection.cursor(name="wildcard_tag_search") as cursor:
+        cursor.itersize = WILDCARD_SEARCH_ITERSIZE
+        cursor.execute(sql_tag_alias_search, (sql_wildcard_string, limit))
+        yield from cursor
+
 def get_tag_info_by_tag_id(tag_id, connection):
-    sql_get_tag_id = "SELECT * FROM tag where ID=%s"
+    _prepare_tag_statements(connection)
+    sql_get_tag_id = "EXECUTE mdb_tag_info(%s)"
     cursor = connection.cursor()
     cursor.execute(sql_get_tag_id, (tag_id,))
     result = cursor.fetchone()
@@ -154,91 +265,95 @@ def get_tag_info_by_tag_id(tag_id, connection):
     return result
 
 def get_tag_aliases(tag_id, connection) -> list[str]:
-    sql_get_tag_id = "SELECT title FROM tag_alias where tag_id=%s"
+    _prepare_tag_statements(connection)
+    sql_get_tag_id = "EXECUTE mdb_tag_aliases(%s)"
     cursor = connection.cursor()
     cursor.execute(sql_get_tag_id, (tag_id,))
-    raw_results = cursor.fetchall()
-    result = []
-    for raw_result in raw_results:
-        result.append(raw_result[0])
+    # array_agg returns NULL for tag without aliases
+    result = cursor.fetchone()[0] or []
     cursor.close()
     return result
 
-def set_tag_properties(tag_id, tag_name, tag_category, connection):
+def set_tag_properties(tag_id, tag_name, tag_category, connection, commit=True):
     sql_set_properties = "UPDATE tag SET title = %s, category = %s where id = %s"
     cursor = connection.cursor()
     cursor.execute(sql_set_properties, (tag_name, tag_category, tag_id))
     cursor.close()
-    connection.commit()
+    if commit:
+        connection.commit()
 
-def add_alias(tag_id, alias_name, connection):
+def add_alias(tag_id, alias_name, connection, commit=True):
     sql_set_properties = "INSERT INTO tag_alias (tag_id, title) VALUES (%s, %s)"
     cursor = connection.cursor()
     cursor.execute(sql_set_properties, (tag_id, alias_name))
     cursor.close()
-    connection.commit()
+    if commit:
+        connection.commit()
 
-def delete_alias(tag_id, alias_name, connection):
+def delete_alias(tag_id, alias_name, connection, commit=True):
     sql_set_properties = "DELETE FROM tag_alias WHERE tag_id = %s AND title = %s"
     cursor = connection.cursor()
     cursor.execute(sql_set_properties, (tag_id, alias_name))
     cursor.close()
-    connection.commit()
+    if commit:
+        connection.commit()
 
 def get_content_ids_by_tag_id(tag_id, connection) -> list[int]:
-    sql_get_content_ids = "SELECT content_id FROM content_tags_list where tag_id = %s"
+    _prepare_tag_statements(connection)
+    sql_get_content_ids = "EXECUTE mdb_content_ids_by_tag(%s)"
     cursor = connection.cursor()
     cursor.execute(sql_get_content_ids, (tag_id,))
-    raw_results = cursor.fetchall()
-    result = []
-    for raw_result in raw_results:
-        result.append(raw_result[0])
+    # array_agg returns NULL for tag without content
+    result = cursor.fetchone()[0] or []
     cursor.close()
     return result
 
-def merge_tags(first_tag_id: int, second_tag_id: int, connection):
+def merge_tags(first_tag_id: int, second_tag_id: int, connection, commit=True, synchronous_commit=True):
     """
     Merge first tag to second tag by their IDs.
     :param first_tag_id: ID of tag that should be deleted
     :param second_tag_id: ID of tag that should stay
     :param connection: Medialib database connection
+    :param commit: if False, caller commits, so several changes share one transaction
+    :param synchronous_commit: if False, merge commit does not wait for WAL flush,
+        so bulk merges are faster, but last merges could be lost on database crash
     """
-    first_content_list = set(get_content_ids_by_tag_id(first_tag_id, connection))
-    second_content_list = set(get_content_ids_by_tag_id(second_tag_id, connection))
-    reset_ids_set = first_content_list - second_content_list
-    remove_first_id_set = first_content_list.intersection(second_content_list)
-    sql_reset_ids = "UPDATE content_tags_list SET tag_id = %s WHERE content_id = %s AND tag_id = %s"
+    # content sets of both tags are compared by database, content IDs are not loaded to client
+    sql_reset_ids = (
+        "UPDATE content_tags_list AS first_tag_link SET tag_id = %s WHERE tag_id = %s AND NOT EXISTS ("
+        "SELECT 1 FROM content_tags_list AS second_tag_link "
+        "WHERE second_tag_link.content_id = first_tag_link.content_id AND second_tag_link.tag_id = %s)"
+    )
     cursor = connection.cursor()
-    logger.info("replace {} tag ID's".format(len(reset_ids_set)))
-    for content_id in reset_ids_set:
-        cursor.execute(sql_reset_ids, (second_tag_id, content_id, first_tag_id))
-    sql_delete_connection = "DELETE FROM content_tags_list WHERE content_id = %s AND tag_id = %s"
-    logger.info("delete {} content to tag connections".format(len(remove_first_id_set)))
-    for content_id in remove_first_id_set:
-        cursor.execute(sql_delete_connection, (content_id, first_tag_id))
-    logger.info("reset aliases")
-    sql_reset_alias = "UPDATE tag_alias SET tag_id = %s WHERE tag_id = %s"
-    cursor.execute(sql_reset_alias, (second_tag_id, first_tag_id))
-    logger.info("check parents")
-    sql_check_parent_of_tag = "SELECT parent FROM tag where id = %s"
-    sql_reset_parent = "UPDATE tag SET parent = NULL where id = %s"
-    cursor.execute(sql_check_parent_of_tag, (second_tag_id,))
-    parent = cursor.fetchone()[0]
-    if parent == first_tag_id:
-        cursor.execute(sql_reset_parent, (second_tag_id,))
-    cursor.execute(sql_check_parent_of_tag, (first_tag_id,))
-    parent = cursor.fetchone()[0]
-    if parent == second_tag_id:
-        cursor.execute(sql_reset_parent, (first_tag_id,))
-    logger.info("REMOVING first tag")
-    sql_delete_first_tag = "DELETE FROM tag WHERE id = %s"
-    cursor.execute(sql_delete_first_tag, (first_tag_id,))
+    cursor.execute(sql_reset_ids, (second_tag_id, first_tag_id, second_tag_id))
+    logger.info("replaced {} tag ID's".format(cursor.rowcount))
+    # links left to first tag are content already connected to second tag
+    sql_delete_connection = "DELETE FROM content_tags_list WHERE tag_id = %s"
+    cursor.execute(sql_delete_connection, (first_tag_id,))
+    logger.info("deleted {} content to tag connections".format(cursor.rowcount))
+    logger.info("reset aliases, check parents and REMOVING first tag")
+    # aliases are moved, tags that are parents of each other are detached and first tag is deleted
+    # by statements sent in one round-trip, alias titles are unique by themselves, so moving can't conflict
+    sql_remove_first_tag = (
+        "UPDATE tag_alias SET tag_id = %s WHERE tag_id = %s;"
+        "UPDATE tag SET parent = NULL where (id = %s AND parent = %s) OR (id = %s AND parent = %s);"
+        "DELETE FROM tag WHERE id = %s;"
+    )
+    if not synchronous_commit:
+        # sent with the last statements, setting is applied to commit of current transaction
+        sql_remove_first_tag += "SET LOCAL synchronous_commit TO OFF;"
+    cursor.execute(
+        sql_remove_first_tag,
+        (second_tag_id, first_tag_id, second_tag_id, first_tag_id, first_tag_id, second_tag_id, first_tag_id)
+    )
     cursor.close()
-    connection.commit()
+    if commit:
+        connection.commit()
 
 def get_tag_id_by_alias(alias, connection):
+    _prepare_tag_statements(connection)
     cursor = connection.cursor()
-    sql_template = "SELECT tag_id FROM tag_alias WHERE title=%s"
+    sql_template = "EXECUTE mdb_tag_id_by_alias(%s)"
     cursor.execute(sql_template, (alias,))
     result = cursor.fetchone()
     if result is not None:
@@ -248,3 +363,49 @@ def get_tag_id_by_alias(alias, connection):
     cursor.close()
     return result
 
+
+def get_tag_ids_by_aliases(aliases, connection) -> dict[str, int]:
+    """
+    Batched version of get_tag_id_by_alias, looks up all aliases with single query.
+    :return: tag ID of every found alias
+    """
+    sql_template = "SELECT title, tag_id FROM tag_alias WHERE title = ANY(%s)"
+    cursor = connection.cursor()
+    cursor.execute(sql_template, (list(aliases),))
+    result = dict(cursor.fetchall())
+    cursor.close()
+    return result
+
+
+def check_tags_exist(tags: list[tuple[str, str]], connection) -> dict[tuple[str, str], int]:
+    """
+    Batched version of check_tag_exists for list of (tag name, category) pairs.
+    Tags are searched by title, not found ones by alias, with one query for each step.
+    :return: tag ID of every found (tag name, category) pair
+    """
+    requested = {(tag_name.replace("_", " "), tag_category) for tag_name, tag_category in tags}
+    found: dict[tuple[str, str], int] = dict()
+    cursor = connection.cursor()
+    sql_select_tags = "SELECT title, category, ID FROM tag WHERE title = ANY(%s)"
+    cursor.execute(sql_select_tags, (list({tag[0] for tag in requested}),))
+    for title, category, tag_id in cursor.fetchall():
+        if (title, category) in requested:
+            found[(title, category)] = tag_id
+    missing = requested - found.keys()
+    if len(missing):
+        sql_select_tags_by_alias = (
+            "SELECT tag_alias.title, tag.category, tag.ID FROM tag_alias JOIN tag ON tag.ID = tag_alias.tag_id "
+            "WHERE tag_alias.title = ANY(%s)"
+        )
+        cursor.execute(sql_select_tags_by_alias, (list({tag[0] for tag in missing}),))
+        for title, category, tag_id in cursor.fetchall():
+            if (title, category) in missing:
+                found[(title, category)] = tag_id
+    cursor.close()
+    result = dict()
+    for tag_name, tag_category in tags:
+        tag_key = (tag_name.replace("_", " "), tag_category)
+        if tag_key in found:
+            result[(tag_name, tag_category)] = found[tag_key]
+    return result
+
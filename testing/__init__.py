@@ -17,17 +17,12 @@ def make_connection():
 
 def wipe():
     connection = make_connection()
-    sql_resuests = [
-        "DELETE FROM content_tags_list",
-        "DELETE FROM thumbnail",
-        "DELETE FROM tag_alias",
-        "DELETE FROM content",
-        "DELETE FROM tag",
-        "ALTER SEQUENCE content_id_seq RESTART WITH 1",
-        "ALTER SEQUENCE tag_id_seq RESTART WITH 1"
-    ]
+    # single statement removes rows of all tables and resets their ID sequences,
+    # tables referencing them are truncated by CASCADE
+    sql_wipe_request = (
+        "TRUNCATE content_tags_list, thumbnail, tag_alias, content, tag RESTART IDENTITY CASCADE"
+    )
     cursor = connection.cursor()
-    for sql_resuest in sql_resuests:
-        cursor.execute(sql_resuest)
+    cursor.execute(sql_wipe_request)
     connection.commit()
     connection.close()